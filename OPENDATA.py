@@ -1,11 +1,31 @@
 import streamlit as st
 from streamlit_folium import st_folium
 import folium
-from folium.plugins import HeatMap, MarkerCluster
+from folium.plugins import HeatMap, FastMarkerCluster
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor
 from gtts import gTTS
 import base64
+import copy
+import hmac
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
 import time
+import zlib
+import unicodedata
+from functools import lru_cache
+from bisect import bisect_left
+from difflib import SequenceMatcher, get_close_matches
+from types import MappingProxyType
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
 import pandas as pd
 import re
 import altair as alt
@@ -26,290 +46,295 @@ st.set_page_config(
 # 1. CONFIGURATION DONNÉES COMPLÈTE
 # ==========================================
 
-CONFIG_VILLES = {
-    "Paris 🗼": {
-        "coords_center": [48.8566, 2.3522],
-        "zoom_start": 12,
-        "api_url": "https://opendata.paris.fr/api/explore/v2.1/catalog/datasets",
-        "cp_prefix": "75",
-        "alias": ["paris", "paname", "75"],
-        "categories": {
-            "🚽 Sanisettes (Toilettes)": {
-                "api_id": "sanisettesparis",
-                "col_titre": "libelle", "col_adresse": "adresse",
-                "icone": "tint", "couleur": "blue", 
-                "infos_sup": [("horaire", "🕒 Horaires"), ("acces_pmr", "♿ PMR")],
-                "mots_cles": ["toilettes", "wc", "pipi", "sanisette"]
-            },
-            "⛲️ Fontaines à boire": {
-                "api_id": "fontaines-a-boire",
-                "col_titre": "voie", "col_adresse": "commune",
-                "icone": "tint", "couleur": "cadetblue", 
-                "infos_sup": [("dispo", "💧 Dispo"), ("type_objet", "⚙️ Type")],
-                "mots_cles": ["eau", "boire", "fontaine"]
-            },
-            "👶 Crèches (Municipales)": {
-                "api_id": "creches-municipales-et-subventionnees",
-                "col_titre": "nom_equipement", "col_adresse": "adresse",
-                "icone": "user", "couleur": "purple",
-                "infos_sup": [("telephone", "📞 Tél")],
-                "mots_cles": ["bebe", "creche", "enfant", "garderie"]
-            },
-            "🎓 Écoles Maternelles": {
-                "api_id": "etablissements-scolaires-maternelles",
-                "col_titre": "libelle", "col_adresse": "adresse",
-                "icone": "child", "couleur": "pink", 
-                "infos_sup": [("public_prive", "🏫 Secteur")],
-                "mots_cles": ["ecole", "maternelle", "enfant"]
-            },
-             "🌳 Espaces Verts (Parcs)": {
-                "api_id": "espaces_verts",
-                "col_titre": "nom_ev", "col_adresse": "adresse_numero",
-                "icone": "tree", "couleur": "green",
-                "infos_sup": [("categorie", "🏷️ Type"), ("surface_totale_reelle", "📏 m²")],
-                "mots_cles": ["parc", "jardin", "promenade", "nature"]
-            },
-            "📅 Sorties & Événements": {
-                "api_id": "que-faire-a-paris-",
-                "col_titre": "title", "col_adresse": "address_name",
-                "icone": "calendar", "couleur": "orange",
-                "infos_sup": [("date_start", "📅 Date"), ("price_type", "💶 Prix"), ("lead_text", "ℹ️ Info")],
-                "image_col": "cover_url",
-                "mots_cles": ["sorties", "evenements", "concert", "expo", "culture"]
-            },
-            "🛜 Bornes Wi-Fi": {
-                "api_id": "sites-disposant-du-service-paris-wi-fi",
-                "col_titre": "nom_site", "col_adresse": "arc_adresse",
-                "icone": "wifi", "couleur": "purple", 
-                "infos_sup": [("etat2", "✅ État"), ("cp", "📮 CP")],
-                "mots_cles": ["wifi", "internet", "web"]
-            },
-            "🏗️ Chantiers Perturbants": {
-                "api_id": "chantiers-perturbants",
-                "col_titre": "objet", "col_adresse": "voie",
-                "icone": "exclamation-triangle", "couleur": "red", 
-                "infos_sup": [("date_fin", "📅 Fin"), ("impact_circulation", "🚗 Impact")],
-                "mots_cles": ["travaux", "chantier", "route"]
-            },
-            "🔬 Laboratoires d'Analyses": {
-                "api_id": "laboratoires-danalyses-medicales",
-                "col_titre": "laboratoire", "col_adresse": "adresse",
-                "icone": "flask", "couleur": "green", 
-                "infos_sup": [("telephone", "📞 Tél"), ("horaires", "🕒 Horaires")],
-                "mots_cles": ["sante", "medecin", "laboratoire","MST"]
-            },
-            "🆘 Défibrillateurs": {
-                "api_id": "defibrillateurs",
-                "col_titre": "nom_etabl", "col_adresse": "adr_post",
-                "icone": "heartbeat", "couleur": "darkred", 
-                "infos_sup": [("acces_daw", "🚪 Accès")],
-                "mots_cles": ["coeur", "defibrillateur", "urgence"]
-            },
-            "🏫 Collèges": {
-                "api_id": "etablissements-scolaires-colleges",
-                "col_titre": "libelle", "col_adresse": "adresse",
-                "icone": "graduation-cap", "couleur": "darkblue", 
-                "infos_sup": [("public_prive", "🏫 Secteur")],
-                "mots_cles": ["college", "education"]
-            },
-            "📉 Qualité de l'Air (Courbes)": {
-                "api_id": "custom_meteo",
-                "col_titre": "", "col_adresse": "",
-                "icone": "area-chart", "couleur": "gray",
-                "infos_sup": [],
-                "mots_cles": ["pollution", "air", "courbe", "graphique", "meteo"]
-            }
-        }
-    },
-    "Rennes 🏁": {
-        "coords_center": [48.1172, -1.6777],
-        "zoom_start": 13,
-        "api_url": "https://data.rennesmetropole.fr/api/explore/v2.1/catalog/datasets",
-        "cp_prefix": "35",
-        "alias": ["rennes", "bretagne", "35"],
-        "categories": {
-            "🅿️ Parkings (Citédia)": {
-                "api_id": "export-api-parking-citedia",
-                "col_titre": "key",
-                "col_adresse": "organname",
-                "icone": "parking", "couleur": "blue",
-                "infos_sup": [("status", "✅ État"), ("free", "🟢 Places Libres"), ("max", "🔢 Total")],
-                "mots_cles": ["parking", "garer", "voiture", "stationnement", "centre", "payant"]
-            },
-            # --- CORRECTION DES CHAMPS POUR PARC RELAIS STAR ---
-            "🅿️ Parcs Relais (STAR)": {
-                "api_id": "tco-parcsrelais-star-etat-tr",
-                "col_titre": "nom", 
-                "col_adresse": "nom", 
-                "icone": "parking", "couleur": "purple",
-                "infos_sup": [
-                    ("etat_ouverture", "🚪 État"), 
-                    ("places_disponibles_soliste_ordinaire", "🟢 Libres"),
-                    ("capacite_place_soliste_ordinaire", "🔢 Capacité"),
-                    ("places_disponibles_pmr", "♿ Libres PMR"),
-                    ("etat_remplissage", "📊 Remplissage")
-                ],
-                "mots_cles": ["relais", "star", "métro", "p+r", "périphérie"]
-            },
-            # ---------------------------------------------------
-            "🚲 Stations Vélo Star (Temps réel)": {
-                "api_id": "etat-des-stations-le-velo-star-en-temps-reel",
-                "col_titre": "nom", 
-                "col_adresse": "nom", 
-                "icone": "bicycle", "couleur": "red",
-                "infos_sup": [("nombrevelosdisponibles", "🚲 Vélos dispo"), ("nombreemplacementsdisponibles", "🅿️ Places dispo")],
-                "mots_cles": ["velo", "bicyclette", "star"]
-            },
-             "🚌 Bus en Circulation (Temps réel)": {
-                "api_id": "position-des-bus-en-circulation-sur-le-reseau-star-en-temps-reel",
-                "col_titre": "nomcourtligne", 
-                "col_adresse": "destination",
-                "icone": "bus", "couleur": "cadetblue",
-                "infos_sup": [("destination", "🏁 Vers"), ("ecartsecondes", "⏱️ Écart (sec)")],
-                "mots_cles": ["bus", "transport", "star"]
-            },
-            "🚽 Toilettes Publiques": {
-                "api_id": "toilettes_publiques_vdr",
-                "col_titre": "nom_toilettes", 
-                "col_adresse": "voie",
-                "icone": "tint", "couleur": "green",
-                "infos_sup": [("quartier", "📍 Quartier"), ("acces_pmr", "♿ PMR")],
-                "mots_cles": ["toilettes", "wc", "pipi"]
-            },
-            "📊 Fréquentation Lignes (Stats uniquement)": {
-                "api_id": "mkt-frequentation-niveau-freq-max-ligne",
-                "col_titre": "ligne",
-                "col_adresse": "tranche_horaire", 
-                "icone": "bar-chart", "couleur": "gray",
-                "infos_sup": [("frequentation", "👥 Charge"), ("tranche_horaire", "🕒 Heure")],
-                "no_map": True,
-                "mots_cles": ["stats", "frequentation", "monde", "charge"]
-            },
-            "📉 Qualité de l'Air (Courbes)": {
-                "api_id": "custom_meteo",
-                "col_titre": "", "col_adresse": "",
-                "icone": "area-chart", "couleur": "gray",
-                "infos_sup": [],
-                "mots_cles": ["pollution", "air", "courbe", "graphique", "meteo"]
-            }
-        }
-    },
-    "Nantes 🐘": {
-        "coords_center": [47.2184, -1.5536],
-        "zoom_start": 13,
-        "api_url": "https://data.nantesmetropole.fr/api/explore/v2.1/catalog/datasets",
-        "cp_prefix": "44",
-        "alias": ["nantes", "naoned", "44"],
-        "categories": {
-            "🌳 Parcs et Jardins": {
-                "api_id": "244400404_parcs-jardins-nantes",
-                "col_titre": "nom_complet", "col_adresse": "adresse",
-                "icone": "tree", "couleur": "green",
-                "infos_sup": [("type", "🏷️ Type"), ("jeux_enfants", "🛝 Jeux")],
-                "mots_cles": ["parc", "jardin", "nature", "promenade"]
-            },
-            "🚽 Toilettes Publiques": {
-                "api_id": "244400404_toilettes-publiques-nantes-metropole",
-                "col_titre": "nom", "col_adresse": "adresse",
-                "icone": "tint", "couleur": "blue",
-                "infos_sup": [("acces_pmr", "♿ PMR"), ("commune", "📍 Ville")],
-                "mots_cles": ["wc", "toilettes", "hygiene"]
-            },
-            "❄️ Îlots de Fraîcheur": {
-                "api_id": "244400404_ilot-fraicheur-nantes-metropole",
-                "col_titre": "nom", "col_adresse": "commune",
-                "icone": "snowflake", "couleur": "lightblue",
-                "infos_sup": [("categorie", "🏷️ Categorie"), ("commune", "📍 Ville")],
-                "mots_cles": ["frais", "canicule", "climat", "nature"]
-            },
-            "🎉 Salles à Louer": {
-                "api_id": "244400404_salles-nantes-disponibles-location",
-                "col_titre": "nom_de_la_salle", 
-                "col_adresse": "adresse",
-                "icone": "building", "couleur": "orange",
-                "infos_sup": [("telephone", "📞 Tél"), ("web", "🌐 Web"), ("capacite_reunion", "👥 Capacité")],
-                "mots_cles": ["salle", "fete", "location", "mariage"]
-            },
-            "📅 Agenda & Événements": {
-                "api_id": "244400404_agenda-evenements-nantes-metropole_v2",
-                "col_titre": "nom", "col_adresse": "lieu",
-                "icone": "calendar", "couleur": "pink",
-                "infos_sup": [("date", "📅 Date"), ("rubrique", "🏷️ Type"), ("description", "ℹ️ Info")],
-                "image_col": "media_1",
-                "mots_cles": ["sortie", "evenement", "culture", "concert"]
-            },
-            "🏊 Piscines": {
-                "api_id": "244400404_piscines-nantes-metropole",
-                "col_titre": "libelle", "col_adresse": "adresse",
-                "icone": "swimmer", "couleur": "blue",
-                "infos_sup": [("telephone", "📞 Tél"), ("horaires_periode_scolaire", "🕒 Horaires")],
-                "mots_cles": ["piscine", "nage", "sport", "eau"]
-            },
-            "🚲 Bicloo (Stations Vélos)": {
-                "api_id": "244400404_stations-velos-libre-service-nantes-metropole",
-                "col_titre": "nom", "col_adresse": "adresse",
-                "icone": "bicycle", "couleur": "red",
-                "infos_sup": [("status", "✅ État"), ("bike_stands", "🔢 Bornes Total"), ("available_bikes", "🚲 Vélos dispo")],
-                "mots_cles": ["velo", "bicloo", "cyclisme", "transport"]
-            },
-            "❤️ Défibrillateurs": {
-                "api_id": "244400404_defibrillateurs-nantes",
-                "col_titre": "nom_site", "col_adresse": "adresse",
-                "icone": "heartbeat", "couleur": "green",
-                "infos_sup": [("acces", "🚪 Accès"), ("emplacement", "📍 Emplacement")],
-                "mots_cles": ["sante", "urgence", "coeur", "secours","défibrilateur"]
-            },
-            "🅿️ Parcs Relais (Dispo)": {
-                "api_id": "244400404_parcs-relais-nantes-metropole-disponibilites",
-                "col_titre": "nom_du_parc", "col_adresse": "adresse",
-                "icone": "parking", "couleur": "purple",
-                "infos_sup": [("grp_disponible", "🟢 Places Dispo"), ("grp_exploitation", "🔢 Total")],
-                "mots_cles": ["parking", "voiture", "tan", "stationnement","garer"]
-            },
-            "🛜 WiFi Public Extérieur": {
-                "api_id": "244400404_wifi-public-exterieur-nantes-metropole",
-                "col_titre": "nom", "col_adresse": "adresse",
-                "icone": "wifi", "couleur": "cadetblue",
-                "infos_sup": [("etat", "✅ État"), ("localisation", "📍 Lieu")],
-                "mots_cles": ["wifi", "internet", "web", "connexion"]
-            },
-            "📉 Qualité de l'Air (Courbes)": {
-                "api_id": "custom_meteo",
-                "col_titre": "", "col_adresse": "",
-                "icone": "area-chart", "couleur": "gray",
-                "infos_sup": [],
-                "mots_cles": ["pollution", "air", "courbe", "graphique", "meteo"]
-            }
-        }
-    }
-}
+# Catalogue des villes : catalogue/index.json (en-têtes des villes), catalogue/themes.json,
+# et un fichier de catégories par ville (chargé à la première sélection de la ville)
+DOSSIER_CATALOGUE = os.environ.get("CITYPULSE_CATALOGUE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalogue"))
+CHAMPS_VILLE_OBLIGATOIRES = ("coords_center", "zoom_start", "api_url", "cp_prefix", "alias", "fichier")
+CHAMPS_CATEGORIE_OBLIGATOIRES = ("api_id", "col_titre", "col_adresse", "icone", "couleur", "infos_sup", "mots_cles")
+THEME_PAR_DEFAUT = "📂 Autres"
+
+journal = logging.getLogger("citypulse")
+
+class CatalogueInvalide(Exception):
+    """ Fichier du catalogue incomplet ou incohérent """
+
+def lire_json(chemin):
+    with open(chemin, encoding="utf-8") as f:
+        return json.load(f)
+
+def trouver_theme(nom_cat, themes):
+    nom_clean = nom_cat.lower()
+    for theme, mots_cles in themes.items():
+        if any(mot in nom_clean for mot in mots_cles):
+            return theme
+    return THEME_PAR_DEFAUT
+
+def compiler_categorie(ville_nom, cat_nom, conf, themes):
+    """ Vérifie une catégorie et précalcule ce que l'interface relisait à chaque rerun """
+    manquants = [c for c in CHAMPS_CATEGORIE_OBLIGATOIRES if c not in conf]
+    if manquants: raise CatalogueInvalide(f"{ville_nom} / {cat_nom} : champs manquants {manquants}")
+    politique = conf.get("rafraichissement", POLITIQUE_PAR_DEFAUT)
+    if not isinstance(politique, (int, float)) and politique not in POLITIQUES_RAFRAICHISSEMENT:
+        raise CatalogueInvalide(f"{ville_nom} / {cat_nom} : politique de rafraîchissement inconnue '{politique}'")
+    if conf.get("mode_chargement", "pages") not in ("pages", "export"):
+        raise CatalogueInvalide(f"{ville_nom} / {cat_nom} : mode de chargement inconnu '{conf['mode_chargement']}'")
+    conf = dict(conf)
+    conf["infos_sup"] = tuple((k, label) for k, label in conf["infos_sup"])
+    conf["mots_cles"] = tuple(conf["mots_cles"])
+    if "champs_sup" in conf: conf["champs_sup"] = tuple(conf["champs_sup"])
+    conf["theme"] = trouver_theme(cat_nom, themes)
+    conf["champs"] = tuple(champs_utiles(conf))
+    return conf
+
+class CatalogueVilles(Mapping):
+    """
+    CONFIG_VILLES : les en-têtes (centre, portail, alias...) sont lus au démarrage,
+    les catégories d'une ville au premier accès à cette ville, une seule fois par process.
+    """
+    def __init__(self, dossier):
+        self.dossier = dossier
+        self.themes = {theme: tuple(mots) for theme, mots in lire_json(os.path.join(dossier, "themes.json")).items()}
+        self.entetes = lire_json(os.path.join(dossier, "index.json"))["villes"]
+        for ville_nom, entete in self.entetes.items():
+            manquants = [c for c in CHAMPS_VILLE_OBLIGATOIRES if c not in entete]
+            if manquants: raise CatalogueInvalide(f"{ville_nom} : champs manquants {manquants}")
+        self.villes = {}
+        self.erreurs = {}  # ville -> dernière erreur de chargement (fichier illisible ou invalide)
+        self.verrou = threading.Lock()
+
+    def __getitem__(self, ville_nom):
+        ville = self.villes.get(ville_nom)
+        if ville is None:
+            entete = self.entetes[ville_nom]
+            with self.verrou:
+                ville = self.villes.get(ville_nom)
+                if ville is None:
+                    ville = self.villes[ville_nom] = self._charger(ville_nom, entete)
+        return ville
+
+    def __iter__(self):
+        return iter(self.entetes)
+
+    def __len__(self):
+        return len(self.entetes)
+
+    def ville_ou_rien(self, ville_nom):
+        """ La ville, ou None si son fichier est invalide : une ville cassée n'empêche pas les autres """
+        try:
+            ville = self[ville_nom]
+        except CatalogueInvalide as e:
+            if self.erreurs.get(ville_nom) != str(e): journal.error("Catalogue : %s", e)
+            self.erreurs[ville_nom] = str(e)
+            return None
+        self.erreurs.pop(ville_nom, None)
+        return ville
+
+    def villes_valides(self):
+        """ (nom, ville) pour toutes les villes chargeables (charge celles qui ne le sont pas encore) """
+        for ville_nom in self.entetes:
+            ville = self.ville_ou_rien(ville_nom)
+            if ville is not None: yield ville_nom, ville
+
+    def date_fichier(self, ville_nom=None):
+        """ Date de modification de index.json (ou du fichier d'une ville), None si absent """
+        nom = "index.json" if ville_nom is None else self.entetes[ville_nom]["fichier"]
+        try: return os.stat(os.path.join(self.dossier, nom)).st_mtime_ns
+        except OSError: return None
+
+    def _charger(self, ville_nom, entete):
+        try:
+            contenu = lire_json(os.path.join(self.dossier, entete["fichier"]))
+        except (OSError, ValueError) as e:
+            raise CatalogueInvalide(f"{ville_nom} : fichier illisible ({e})") from e
+        if not isinstance(contenu.get("categories"), dict): raise CatalogueInvalide(f"{ville_nom} : pas de catégories")
+        categories = {cat_nom: compiler_categorie(ville_nom, cat_nom, conf, self.themes)
+                      for cat_nom, conf in contenu["categories"].items()}
+        if not categories: raise CatalogueInvalide(f"{ville_nom} : aucune catégorie")
+        ville = {**entete, **contenu, "categories": categories}
+        # Thème -> catégories (ordre du fichier), pour les listes de la barre latérale
+        ville["cats_par_theme"] = {}
+        for cat_nom, conf in categories.items():
+            ville["cats_par_theme"].setdefault(conf["theme"], []).append(cat_nom)
+        return ville
+
+@st.cache_resource(show_spinner=False)
+def catalogue_villes():
+    return CatalogueVilles(DOSSIER_CATALOGUE)
+
+PAGE_API = 100             # Taille max d'une page /records (limite Opendatasoft)
+NB_REQUETES_PARALLELES = 4  # Pages téléchargées en même temps par chargement
+LIMITE_EXPORT = 50000       # Garde-fou mémoire pour le mode "export" (jeu complet)
+
+# Délais réseau : un portail lent ne doit jamais figer la page
+TIMEOUT_CONNEXION = 3.05     # secondes (par requête)
+TIMEOUT_LECTURE = 10
+BUDGET_CHARGEMENT = 20       # secondes max pour un jeu complet (au-delà : résultat partiel)
+NB_ESSAIS = 3                # 1 essai + 2 reprises sur 429 / 5xx / coupure
+PAUSE_REPRISE = 0.5          # base du backoff exponentiel (avec gigue)
+CODES_A_REESSAYER = {429, 500, 502, 503, 504}
+SEUIL_DISJONCTEUR = 5        # échecs d'affilée avant de couper un portail
+DUREE_DISJONCTEUR = 60       # secondes pendant lesquelles le portail n'est plus sollicité
+
+# Fiches des jeux (schéma + date de modification)
+TTL_METADONNEES = 3600       # au-delà, la fiche est servie périmée et rafraîchie en arrière-plan
+BUDGET_METADONNEES = 5       # secondes max pour aller chercher une fiche absente
+PAUSE_ECHEC_METADONNEES = 30  # après un échec, on ne resollicite pas le portail avant ce délai
+VARIANTE_FICHE = "fiche"     # Ligne du cache disque qui garde la fiche
 
 COLONNES_CP_A_SCANNER = ["cp", "code_postal", "code_post", "zipcode", "commune", "location_address", "cp_arrondissement", "address_zipcode", "arrondissement"]
+COLONNES_INSEE = ["code_insee", "insee", "code_commune", "codeinsee", "com_insee"]  # Résolveur "commune"
+COLONNES_COMMUNE = ["commune", "ville", "nom_commune"]
+RE_PARIS_ARRONDISSEMENT = re.compile(r"paris\s*(\d+)", re.IGNORECASE)
+# Champs lus par recuperer_coordonnees (gardés dans la projection select=)
+CHAMPS_COORDONNEES = ["geom_x_y", "location", "latitude", "longitude", "lat_lon", "geo",
+                      "geolocalisation", "coordonnees", "geo_point_2d", "xy", "geometry"]
 URL_LOGO = "logo_pulse.png" 
 
+# Cache disque (survit aux redémarrages / déploiements)
+DOSSIER_CACHE = os.environ.get("CITYPULSE_CACHE_DIR", ".cache_citypulse")
+TAILLE_MAX_CACHE_DISQUE = 200 * 1024 * 1024  # 200 Mo, au-delà on évince les moins lus
+TTL_DONNEES = 7200
+MAX_JEUX_EN_MEMOIRE = 200  # Jeux gardés en mémoire (toutes sessions confondues)
+
+# Préchauffage : toutes les catégories restent chargées selon leur politique
+PERIODE_PRECHAUFFAGE = 10   # secondes entre deux passages du planificateur
+PRECHAUFFAGE_WORKERS = 6
+PRECHAUFFAGE_PAR_HOTE = 2   # jeux chargés en même temps par portail (on ne martèle personne)
+
+# Politiques de rafraîchissement (clé "rafraichissement" d'une catégorie, ou un nombre de secondes)
+# None = statique : on ne recharge que si la date de modification du jeu change
+POLITIQUES_RAFRAICHISSEMENT = {
+    "temps_reel": 60,
+    "horaire": 3600,
+    "quotidien": 86400,
+    "statique": None,
+}
+POLITIQUE_PAR_DEFAUT = "horaire"
+# En dessous, pas de revalidation sur la fiche : un flux temps réel change sans que le portail la touche
+DUREE_MIN_REVALIDATION = 3600
+
+CONFIG_VILLES = catalogue_villes()
+
 # ==========================================
 # 2. FONCTIONS UTILES (BACKEND)
 # ==========================================
 
-def moteur_recherche(requete, config):
-    """ Recherche Ville + Catégorie (ex: 'Wifi Paris') """
-    requete = requete.lower().strip()
-    ville_trouvee = None
-    cat_trouvee = None
+# --- INDEX DE LA RECHERCHE MAGIQUE (ville + catégorie) ---
+MOTS_VIDES = {"de", "du", "des", "la", "le", "les", "un", "une", "a", "au", "aux", "en", "et", "l", "d", "pour", "sur", "dans", "je", "cherche", "trouve", "moi"}
+POIDS_RECHERCHE = {"nom": 2.0, "mot_cle": 1.5}  # Mot du nom de la catégorie / mot-clé
+SEUIL_FLOU = 0.8  # Similarité minimale (difflib) pour corriger une faute de frappe / de dictée
+BONUS_VILLE_CITEE = 10.0  # La ville nommée dans la requête l'emporte
+BONUS_VILLE_COURANTE = 0.5  # Sans ville nommée : à égalité, la ville affichée
 
-    for ville_nom, ville_data in config.items():
-        mots_ville = [ville_nom.lower().split()[0]] + ville_data.get("alias", [])
-        if any(mot in requete for mot in mots_ville):
-            ville_trouvee = ville_nom
-            break
-    
-    if ville_trouvee:
-        categories = config[ville_trouvee]["categories"]
-        for cat_nom, cat_data in categories.items():
-            mots_cat = [cat_nom.lower()] + cat_data.get("mots_cles", [])
-            if any(k in requete for k in mots_cat):
-                cat_trouvee = cat_nom
-                break
+def racine(mot):
+    """ Pluriel grossier : 'toilettes' -> 'toilette', 'parkings' -> 'parking' """
+    return mot[:-1] if len(mot) > 3 and mot[-1] in "sx" else mot
+
+def mots_requete(texte):
+    return [racine(m) for m in tokeniser(texte) if m not in MOTS_VIDES and len(m) > 1]
+
+def _index_mots(mots_poids):
+    """ [(mot, valeur)] -> mot -> [valeurs], + vocabulaire trié pour les préfixes et le flou """
+    mots = {}
+    for mot, valeur in mots_poids:
+        mots.setdefault(mot, []).append(valeur)
+    return {"mots": mots, "vocabulaire": sorted(mots)}
+
+def construire_index_villes(entetes):
+    """ Mot normalisé (nom, alias) -> villes : ne lit que index.json """
+    return _index_mots((mot, ville_nom) for ville_nom, entete in entetes.items()
+                       for mot in set(mots_requete(" ".join([ville_nom] + list(entete.get("alias", []))))))
+
+def construire_index_categories(ville_data):
+    """ Mot normalisé -> (catégorie, poids) pour une ville (nom de la catégorie > mot-clé) """
+    paires = []
+    for cat_nom, cat_data in ville_data["categories"].items():
+        poids_mots = {mot: POIDS_RECHERCHE["mot_cle"] for mot in mots_requete(" ".join(cat_data.get("mots_cles", [])))}
+        poids_mots.update({mot: POIDS_RECHERCHE["nom"] for mot in mots_requete(cat_nom)})
+        paires += [(mot, (cat_nom, poids)) for mot, poids in poids_mots.items()]
+    index = _index_mots(paires)
+    index["ordre"] = {cat_nom: i for i, cat_nom in enumerate(ville_data["categories"])}
+    return index
+
+@st.cache_resource(show_spinner=False)
+def index_recherche_par_catalogue():
+    return {}  # (dossier, ville ou None, date du fichier) -> index
+
+def index_recherche(catalogue, ville_nom=None):
+    """
+    Index des villes (ville_nom None) ou des catégories d'une ville, construit une fois
+    par version du fichier : index.json pour les villes, le fichier de la ville sinon.
+    None si la ville est invalide.
+    """
+    cle = (catalogue.dossier, ville_nom, catalogue.date_fichier(ville_nom))
+    indexes = index_recherche_par_catalogue()
+    index = indexes.get(cle)
+    if index is None:
+        if ville_nom is None:
+            index = construire_index_villes(catalogue.entetes)
+        else:
+            ville_data = catalogue.ville_ou_rien(ville_nom)
+            if ville_data is None: return None
+            index = construire_index_categories(ville_data)
+        indexes[cle] = index
+    return index
+
+def _correspondances(index, mot):
+    """ Mots du vocabulaire proches d'un mot de la requête -> similarité (1 = exact) """
+    if mot in index["mots"]: return {mot: 1.0}
+    vocabulaire = index["vocabulaire"]
+    if len(mot) >= 4:
+        # Début de mot ('defib' -> 'defibrillateur')
+        debut, fin = bisect_left(vocabulaire, mot), bisect_left(vocabulaire, mot + "{")
+        if fin > debut: return {v: 0.9 for v in vocabulaire[debut:fin]}
+    # Faute de frappe / de dictée ('defibrilateur', 'sanisète')
+    return {v: SequenceMatcher(None, mot, v).ratio() for v in get_close_matches(mot, vocabulaire, n=3, cutoff=SEUIL_FLOU)}
+
+def rechercher(requete, catalogue, k=5, ville_courante=None):
+    """
+    Top-k (score, ville, catégorie) pour une requête libre ; catégorie None si seule la ville est reconnue.
+    Si la requête cite une ville, seules ses catégories sont lues (fichier chargé au besoin).
+    """
+    mots = mots_requete(requete)
+    index_villes = index_recherche(catalogue)
+    score_villes, mots_villes = {}, set()
+    for mot in mots:
+        for voisin, similarite in _correspondances(index_villes, mot).items():
+            if similarite == 1.0: mots_villes.add(mot)
+            for ville_nom in index_villes["mots"][voisin]:
+                score_villes[ville_nom] = max(score_villes.get(ville_nom, 0), similarite)
+
+    rangs_villes = {ville_nom: i for i, ville_nom in enumerate(catalogue.entetes)}
+    score_cats, ordre = {}, {}
+    for ville_nom in score_villes or catalogue.entetes:
+        index = index_recherche(catalogue, ville_nom)
+        if index is None: continue  # Fichier de la ville invalide : on passe
+        for mot in mots:
+            # Un nom de ville exact ne sert pas de mot de catégorie approché
+            proches = ({mot: 1.0} if mot in index["mots"] else {}) if mot in mots_villes else _correspondances(index, mot)
+            for voisin, similarite in proches.items():
+                for cat_nom, poids in index["mots"][voisin]:
+                    cle = (ville_nom, cat_nom)
+                    score_cats[cle] = score_cats.get(cle, 0) + poids * similarite
+                    ordre[cle] = (rangs_villes[ville_nom], index["ordre"][cat_nom])
+
+    def bonus(ville_nom):
+        if ville_nom in score_villes: return BONUS_VILLE_CITEE * score_villes[ville_nom]
+        return BONUS_VILLE_COURANTE if ville_nom == ville_courante else 0
+    candidats = [(score + bonus(ville_nom), ville_nom, cat_nom) for (ville_nom, cat_nom), score in score_cats.items()]
+    # Ville citée sans catégorie reconnue
+    for ville_nom, score in score_villes.items():
+        if not any(v == ville_nom for _, v, _ in candidats):
+            candidats.append((BONUS_VILLE_CITEE * score, ville_nom, None))
+            ordre[(ville_nom, None)] = (rangs_villes[ville_nom], -1)
+    candidats.sort(key=lambda c: (-c[0], ordre[(c[1], c[2])]))  # À égalité : ordre du catalogue
+    return candidats[:k]
+
+def moteur_recherche(requete, catalogue, ville_courante=None):
+    """ Recherche Ville + Catégorie (ex: 'Wifi Paris') ; sans ville citée, la ville courante est préférée """
+    candidats = rechercher(requete, catalogue, k=1, ville_courante=ville_courante)
+    if not candidats: return None, None
+    _, ville_trouvee, cat_trouvee = candidats[0]
     return ville_trouvee, cat_trouvee
 
 def convert_time_to_float(time_str):
@@ -390,118 +415,1442 @@ def recuperer_coordonnees(site):
 
     return None, None
 
-def extraire_cp_intelligent(site_data, col_adresse_config, prefixe_cp="75"):
+# --- COORDONNÉES EN MASSE (schéma appris une fois par jeu) ---
+def _schema_coordonnees(site):
+    """ (clé, forme) utilisée par recuperer_coordonnees pour cet enregistrement (même priorité) """
+    val = site.get("geom_x_y")
+    if isinstance(val, dict): return ("geom_x_y", "dict")
+    if isinstance(val, list) and len(val) == 2: return ("geom_x_y", "liste")
+    for cle in ["location", "lat_lon", "geo"]:
+        if isinstance(site.get(cle), dict): return (cle, "dict")
+    if "latitude" in site and "longitude" in site: return ("latitude", "colonnes")
+    for cle in ["geolocalisation", "coordonnees", "geo_point_2d", "xy"]:
+        val = site.get(cle)
+        if val:
+            if isinstance(val, dict): return (cle, "dict")
+            if isinstance(val, list) and len(val) == 2: return (cle, "liste")
+            if isinstance(val, str) and "," in val: return (cle, "chaine")
+    geom = site.get("geometry")
+    if isinstance(geom, dict) and geom.get("coordinates"): return ("geometry", "geojson")
+    return None
+
+def detecter_geometrie(lignes, echantillon=30):
+    """ Où sont les coordonnées dans ce jeu ? Vote sur les premiers enregistrements """
+    votes = {}
+    for site in lignes[:echantillon]:
+        schema = _schema_coordonnees(site)
+        if schema: votes[schema] = votes.get(schema, 0) + 1
+    return max(votes, key=votes.get) if votes else None
+
+def _en_float(valeurs):
+    return pd.to_numeric(pd.Series(valeurs, dtype=object), errors="coerce").to_numpy(dtype=float, copy=True)
+
+def _centroides(geometries):
+    """ Points GeoJSON + moyenne des sommets des polygones, calculée d'un bloc avec NumPy """
+    n = len(geometries)
+    lat, lon = np.full(n, np.nan), np.full(n, np.nan)
+    blocs, positions = [], []
+    for i, geom in enumerate(geometries):
+        if not isinstance(geom, dict) or not geom.get("coordinates"): continue
+        g_type, coords = geom.get("type"), geom["coordinates"]
+        try:
+            if g_type == "Point":
+                lon[i], lat[i] = float(coords[0]), float(coords[1])
+            elif g_type in ["Polygon", "MultiPolygon"]:
+                anneaux = coords if g_type == "Polygon" else [a for poly in coords for a in poly]
+                sommets = np.concatenate([np.asarray(a, dtype=float)[:, :2] for a in anneaux])
+                if len(sommets):
+                    blocs.append(sommets)
+                    positions.append(i)
+        except (TypeError, ValueError, IndexError):
+            continue
+    if blocs:
+        tailles = np.array([len(b) for b in blocs])
+        debuts = np.concatenate([[0], np.cumsum(tailles)[:-1]])
+        moyennes = np.add.reduceat(np.concatenate(blocs), debuts, axis=0) / tailles[:, None]
+        lon[positions], lat[positions] = moyennes[:, 0], moyennes[:, 1]
+    return lat, lon
+
+def extraire_coordonnees(lignes):
     """
-    Extraction INTELLIGENTE pour Paris (gère 'PARIS 12E', '75012', etc.)
+    Coordonnées de tout un jeu en tableaux NumPy {lat, lon, valide, schema}.
+    Les enregistrements hors schéma repassent par recuperer_coordonnees.
     """
-    regex_std = rf'{prefixe_cp}\d{{3}}'
-    
-    # 1. Scan des colonnes candidates
-    for col in COLONNES_CP_A_SCANNER:
-        val = str(site_data.get(col, "")).strip()
-        
-        # A. Cas standard : 75012
-        match = re.search(regex_std, val)
-        if match:
-            return match.group(0)
-            
-        # B. Cas Spécial Paris : "PARIS 12E ARRDT" (pour Fontaines)
-        if prefixe_cp == "75" and "paris" in val.lower():
-            match_arr = re.search(r"paris\s*(\d+)", val.lower())
-            if match_arr:
-                num = int(match_arr.group(1))
-                if 1 <= num <= 20:
-                    return f"75{num:03d}" # Transforme 12 en 75012
-
-    # 2. Scan de l'adresse brute
-    adresse = str(site_data.get(col_adresse_config, ""))
-    match = re.search(regex_std, adresse)
-    if match:
-        return match.group(0)
-    
-    # 3. Scan adresse brute pour "Paris Xe"
-    if prefixe_cp == "75" and "paris" in adresse.lower():
-        match_arr = re.search(r"paris\s*(\d+)", adresse.lower())
-        if match_arr:
-            num = int(match_arr.group(1))
-            if 1 <= num <= 20:
-                return f"75{num:03d}"
+    n = len(lignes)
+    lat, lon = np.full(n, np.nan), np.full(n, np.nan)
+    schema = detecter_geometrie(lignes)
+    if schema:
+        cle, forme = schema
+        valeurs = [site.get(cle) for site in lignes]
+        if forme == "dict":
+            lat = _en_float([next((v[k] for k in ("lat", "latitude", "y") if v.get(k) is not None), None) if isinstance(v, dict) else None for v in valeurs])
+            lon = _en_float([next((v[k] for k in ("lon", "longitude", "x") if v.get(k) is not None), None) if isinstance(v, dict) else None for v in valeurs])
+        elif forme == "liste":
+            paires = [v if isinstance(v, list) and len(v) == 2 else (None, None) for v in valeurs]
+            lat, lon = _en_float([p[0] for p in paires]), _en_float([p[1] for p in paires])
+        elif forme == "colonnes":
+            lat, lon = _en_float(valeurs), _en_float([site.get("longitude") for site in lignes])
+        elif forme == "chaine":
+            parties = pd.Series([v if isinstance(v, str) else None for v in valeurs], dtype=object).str.split(",", n=1, expand=True)
+            if parties.shape[1] == 2:
+                lat = pd.to_numeric(parties[0].str.strip(), errors="coerce").to_numpy(dtype=float, copy=True)
+                lon = pd.to_numeric(parties[1].str.strip(), errors="coerce").to_numpy(dtype=float, copy=True)
+        elif forme == "geojson":
+            lat, lon = _centroides(valeurs)
+
+    # Rattrapage au cas par cas (jeux hétérogènes)
+    for i in np.flatnonzero(~(np.isfinite(lat) & np.isfinite(lon))):
+        la, lo = recuperer_coordonnees(lignes[i])
+        try: lat[i], lon[i] = float(la), float(lo)
+        except (TypeError, ValueError): pass
+
+    valide = np.isfinite(lat) & np.isfinite(lon) & (lat != 0) & (lon != 0)
+    return {"lat": lat, "lon": lon, "valide": valide, "schema": schema}
+
+def coordonnees_jeu(entree):
+    """ Coordonnées du jeu, extraites une fois par version puis partagées """
+    return derive(entree, "coordonnees", extraire_coordonnees)
 
-    return "Inconnu"
+@lru_cache(maxsize=None)
+def motif_cp(prefixe_cp):
+    """ Regex CP compilée une seule fois par préfixe (ex: 75 -> 75xxx) """
+    return re.compile(rf"({prefixe_cp}\d{{3}})")
 
-def jouer_son_automatique(texte):
+# --- RÉSOLVEURS DE CODE POSTAL (colonne par colonne, sur tout le jeu) ---
+def replier_texte(serie):
+    """ Minuscules, sans accents ni tirets (ex: 'Saint-Sébastien' -> 'saint sebastien') """
+    return (serie.str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+                 .str.lower().str.replace("-", " ", regex=False).str.strip())
+
+def _colonne_texte(df, col):
+    if not col or col not in df.columns: return None
+    return df[col].astype(str).str.strip()
+
+def _cp_arrondissement_paris(textes):
+    """ 'PARIS 12E ARRDT' -> '75012' """
+    num = pd.to_numeric(textes.str.extract(RE_PARIS_ARRONDISSEMENT, expand=False), errors="coerce")
+    return num.where(num.between(1, 20)).map(lambda n: f"75{int(n):03d}", na_action="ignore")
+
+def resoudre_cp_standard(df, config_ville, config_data, arrondissements=False):
+    """ Colonnes candidates, puis adresse, puis address_zipcode (le premier CP trouvé l'emporte) """
+    prefixe = config_ville["cp_prefix"]
+    cp = pd.Series(np.nan, index=df.index, dtype=object)
+    for col in COLONNES_CP_A_SCANNER + [config_data["col_adresse"]]:
+        textes = _colonne_texte(df, col)
+        if textes is None: continue
+        trouve = textes.str.extract(motif_cp(prefixe), expand=False)
+        if arrondissements: trouve = trouve.fillna(_cp_arrondissement_paris(textes))
+        cp = cp.fillna(trouve)
+    code_brut = _colonne_texte(df, "address_zipcode")
+    if code_brut is not None:
+        cp = cp.fillna(code_brut.where(code_brut.str.contains(prefixe, regex=False)))
+    return cp
+
+def resoudre_cp_paris(df, config_ville, config_data):
+    return resoudre_cp_standard(df, config_ville, config_data, arrondissements=True)
+
+def resoudre_commune(df, config_ville, config_data):
+    """
+    Commune (nom du catalogue) : code INSEE, puis nom de commune, puis code postal.
+    Une seule étiquette par commune : 35238, 'RENNES' et 35200 donnent tous 'Rennes'.
+    """
+    prefixe = config_ville["cp_prefix"]
+    communes_insee = config_ville.get("communes_insee", {})
+    par_insee = {code: nom for nom, code in communes_insee.items()}
+    par_cp = {cp: nom for nom, cps in config_ville.get("codes_postaux", {}).items() for cp in cps}
+    commune = pd.Series(np.nan, index=df.index, dtype=object)
+    for col in COLONNES_INSEE:
+        textes = _colonne_texte(df, col)
+        if textes is not None: commune = commune.fillna(textes.str.extract(motif_cp(prefixe), expand=False).map(par_insee))
+    noms = dict(zip(replier_texte(pd.Series(list(communes_insee), dtype=object)), communes_insee))
+    if noms:
+        for col in COLONNES_COMMUNE + [config_data["col_adresse"]]:
+            textes = _colonne_texte(df, col)
+            if textes is not None: commune = commune.fillna(replier_texte(textes).map(noms))
+    # CP d'une commune hors catalogue : gardé tel quel plutôt que perdu
+    cp = resoudre_cp_standard(df, config_ville, config_data)
+    return commune.fillna(cp.map(par_cp)).fillna(cp)
+
+# Résolveur choisi par ville (clé "resolveur_cp" de CONFIG_VILLES)
+RESOLVEURS_CP = {
+    "standard": resoudre_cp_standard,
+    "paris": resoudre_cp_paris,
+    "commune": resoudre_commune,
+}
+
+def libelle_zone(config_ville):
+    """ Nom de la colonne 'cp' à l'écran : commune ou code postal selon le résolveur de la ville """
+    return "Commune" if config_ville.get("resolveur_cp") == "commune" else "CP"
+
+def resoudre_cp(df, config_ville, config_data):
+    """ Colonne 'zone / CP' de tout un jeu (NaN si rien trouvé) """
+    if df.empty: return pd.Series([], dtype=object)
+    resolveur = RESOLVEURS_CP.get(config_ville.get("resolveur_cp", "standard"), resoudre_cp_standard)
+    return resolveur(df, config_ville, config_data)
+
+# --- ASSISTANT VOCAL (synthèse en mémoire, partagée entre les sessions) ---
+ATTENTE_MAX_VOIX = 5  # s : une annonce toujours pas synthétisée après ce délai est abandonnée
+
+@st.cache_resource(show_spinner=False)
+def cache_voix():
+    """ Texte -> MP3 (octets), + synthèses en cours (une seule par texte) """
+    return {"sons": {}, "en_vol": {}, "verrou": threading.Lock()}
+
+def phrase_chargement(ville_nom, cat_nom):
+    return f"Chargement : {ville_nom}, {cat_nom}"
+
+def synthetiser(texte):
+    """ gTTS directement en mémoire (pas de fichier temporaire partagé) """
+    tampon = io.BytesIO()
+    gTTS(text=texte, lang='fr').write_to_fp(tampon)
+    return tampon.getvalue()
+
+def _synthetiser_en_fond(cache, texte, futur):
     try:
-        tts = gTTS(text=texte, lang='fr')
-        nom_fichier = "temp_voice.mp3"
-        tts.save(nom_fichier)
-        with open(nom_fichier, "rb") as f:
-            data = f.read()
-            b64 = base64.b64encode(data).decode()
-        md = f"""<audio autoplay><source src="data:audio/mp3;base64,{b64}" type="audio/mp3"></audio>"""
-        st.sidebar.markdown(md, unsafe_allow_html=True)
-        time.sleep(1)
-    except:
-        pass
+        son = synthetiser(texte)
+        with cache["verrou"]:
+            cache["sons"][texte] = son
+        futur.set_result(son)
+    except Exception as e:
+        futur.set_exception(e)
+    finally:
+        with cache["verrou"]:
+            cache["en_vol"].pop(texte, None)
 
-# CACHE ACTIF (2 HEURES)
-@st.cache_data(ttl=7200, show_spinner=False) 
-def charger_donnees(base_url, api_id, cible=500):
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    url = f"{base_url}/{api_id}/records"
-    tous_les_resultats = []
-    
-    for offset in range(0, cible, 100):
-        params = {"limit": 100, "offset": offset}
+def demander_son(texte):
+    """ Future du MP3 d'une phrase : immédiat si déjà synthétisé, sinon synthèse en arrière-plan """
+    cache = cache_voix()
+    with cache["verrou"]:
+        futur = cache["en_vol"].get(texte)
+        if futur is not None: return futur
+        futur = Future()
+        if texte in cache["sons"]:
+            futur.set_result(cache["sons"][texte])
+            return futur
+        cache["en_vol"][texte] = futur
+    threading.Thread(target=_synthetiser_en_fond, args=(cache, texte, futur), daemon=True, name="voix").start()
+    return futur
+
+def prechauffer_voix():
+    """ Synthétise d'avance toutes les annonces "Chargement : ville, catégorie" (une à la fois) """
+    for ville_nom, config_ville in CONFIG_VILLES.villes_valides():
+        for cat_nom in config_ville["categories"]:
+            try: demander_son(phrase_chargement(ville_nom, cat_nom)).result()
+            except Exception: pass
+
+def jouer_son_automatique(emplacement, texte):
+    """
+    Appelé en fin de script, sans jamais attendre la synthèse :
+    True = jouée, False = synthèse en échec, None = pas encore prête (à reprendre au prochain rerun).
+    """
+    futur = demander_son(texte)
+    if not futur.done(): return None
+    try:
+        data = futur.result()
+    except Exception:
+        return False
+    b64 = base64.b64encode(data).decode()
+    md = f"""<audio autoplay><source src="data:audio/mp3;base64,{b64}" type="audio/mp3"></audio>"""
+    emplacement.markdown(md, unsafe_allow_html=True)
+    return True
+
+@st.cache_resource(show_spinner=False)
+def session_http():
+    """ Session HTTP partagée (keep-alive + gzip) : une seule poignée TLS par portail """
+    session = requests.Session()
+    adaptateur = HTTPAdapter(pool_connections=10, pool_maxsize=NB_REQUETES_PARALLELES * 2)
+    session.mount("https://", adaptateur)
+    session.mount("http://", adaptateur)
+    session.headers.update({"User-Agent": "Mozilla/5.0", "Accept-Encoding": "gzip, deflate"})
+    return session
+
+class PortailIndisponible(Exception):
+    """ Portail en échec : disjoncteur ouvert, budget épuisé ou erreurs répétées """
+
+# --- DISJONCTEUR PAR PORTAIL ---
+@st.cache_resource(show_spinner=False)
+def disjoncteurs():
+    """ État par hôte : échecs consécutifs + date de réouverture """
+    return {"hotes": {}, "verrou": threading.Lock()}
+
+def disjoncteur_ouvert(hote):
+    etat = disjoncteurs()
+    with etat["verrou"]:
+        hote_etat = etat["hotes"].get(hote)
+        return bool(hote_etat) and hote_etat["ouvert_jusqu_a"] > time.time()
+
+def noter_appel(hote, succes):
+    etat = disjoncteurs()
+    with etat["verrou"]:
+        hote_etat = etat["hotes"].setdefault(hote, {"echecs": 0, "ouvert_jusqu_a": 0})
+        if succes:
+            hote_etat["echecs"] = 0
+        else:
+            hote_etat["echecs"] += 1
+            if hote_etat["echecs"] >= SEUIL_DISJONCTEUR:
+                hote_etat["ouvert_jusqu_a"] = time.time() + DUREE_DISJONCTEUR
+
+def requete_http(url, params=None, headers=None, stream=False, echeance=None):
+    """
+    GET avec timeout, reprises (backoff + gigue) sur 429/5xx/coupure et disjoncteur par hôte.
+    echeance = time.monotonic() limite du chargement en cours (None = timeouts seuls).
+    """
+    hote = urlparse(url).netloc
+    if disjoncteur_ouvert(hote):
+        raise PortailIndisponible(f"{hote} : portail coupé temporairement")
+
+    for essai in range(NB_ESSAIS):
+        reste = TIMEOUT_LECTURE if echeance is None else echeance - time.monotonic()
+        if reste <= 0: raise PortailIndisponible(f"{hote} : budget de chargement épuisé")
         try:
-            response = requests.get(url, params=params, headers=headers)
-            data = response.json()
-            if "results" not in data: break
-            batch = data.get("results", [])
+            r = session_http().get(url, params=params, headers=headers, stream=stream,
+                                   timeout=(min(TIMEOUT_CONNEXION, reste), min(TIMEOUT_LECTURE, reste)))
+        except (requests.ConnectionError, requests.Timeout):
+            r = None
+        if r is not None and r.status_code not in CODES_A_REESSAYER:
+            noter_appel(hote, True)
+            return r
+        if essai == NB_ESSAIS - 1: break
+
+        attente = PAUSE_REPRISE * (2 ** essai) * random.uniform(0.5, 1.5)
+        if r is not None:
+            if r.status_code == 429 and str(r.headers.get("Retry-After", "")).isdigit():
+                attente = max(attente, int(r.headers["Retry-After"]))
+            r.close()
+        if echeance is not None and time.monotonic() + attente >= echeance: break
+        time.sleep(attente)
+
+    noter_appel(hote, False)
+    raise PortailIndisponible(f"{hote} : pas de réponse exploitable")
+
+def lire_page(url, offset, params_sup=None, echeance=None):
+    """ Une page de /records (None si la réponse n'est pas exploitable) """
+    params = {"limit": PAGE_API, "offset": offset}
+    if params_sup: params.update(params_sup)
+    try:
+        data = requete_http(url, params=params, echeance=echeance).json()
+    except Exception:
+        return None
+    if "results" not in data: return None
+    return data
+
+def recuperer_pages(url, cible, params_sup=None, echeance=None):
+    """
+    Moteur de pagination : la 1ère page donne 'total_count',
+    les pages suivantes partent en parallèle (ordre des offsets conservé).
+    Renvoie (resultats, partiel) : partiel = pages manquantes (échec ou budget épuisé).
+    """
+    premiere = lire_page(url, 0, params_sup, echeance)
+    if premiere is None: return [], True
+    tous_les_resultats = list(premiere["results"])
+    if len(tous_les_resultats) < PAGE_API: return tous_les_resultats, False
+
+    # On s'arrête au vrai nombre de lignes quand l'API le donne
+    total = premiere.get("total_count")
+    fin = min(cible, total) if isinstance(total, int) else cible
+    offsets = list(range(PAGE_API, fin, PAGE_API))
+    if not offsets: return tous_les_resultats, False
+
+    partiel = False
+    with ThreadPoolExecutor(max_workers=min(NB_REQUETES_PARALLELES, len(offsets))) as pool:
+        pages = pool.map(lambda off: lire_page(url, off, params_sup, echeance), offsets)
+        for page in pages:
+            # Page en échec = on garde ce qui précède (pas de trou dans les offsets)
+            if page is None:
+                partiel = True
+                break
+            batch = page["results"]
             tous_les_resultats.extend(batch)
-            if len(batch) < 100: break
-        except: break
-    return tous_les_resultats
-
-@st.cache_data
-def charger_meteo_pollution(lat, lon):
-    url = "https://air-quality-api.open-meteo.com/v1/air-quality"
-    params = {
-        "latitude": lat,
-        "longitude": lon,
+            if len(batch) < PAGE_API: break
+    return tous_les_resultats, partiel
+
+def charger_export(base_url, api_id, limite=LIMITE_EXPORT, params_sup=None, echeance=None):
+    """
+    Mode "export" : tout le jeu en UNE requête via /exports/jsonl.
+    Le corps est lu en flux ligne par ligne (un enregistrement JSON par ligne).
+    Renvoie (resultats, partiel).
+    """
+    url = f"{base_url}/{api_id}/exports/jsonl"
+    params = {"limit": limite}
+    if params_sup: params.update(params_sup)
+    tous_les_resultats = []
+    try:
+        with requete_http(url, params=params, stream=True, echeance=echeance) as response:
+            if response.status_code != 200: return [], True
+            for ligne in response.iter_lines(chunk_size=65536):
+                if echeance is not None and time.monotonic() > echeance: return tous_les_resultats, True
+                if not ligne: continue
+                try: tous_les_resultats.append(json.loads(ligne))
+                except ValueError: continue
+                if len(tous_les_resultats) >= limite: break
+    except Exception:
+        return tous_les_resultats, True
+    return tous_les_resultats, False
+
+# --- FICHES DES JEUX (stale-while-revalidate, comme les données) ---
+@st.cache_resource(show_spinner=False)
+def registre_fiches():
+    """ Fiches communes au process : cle -> {"meta", "charge_le", "echec_le"} + rafraîchissements en cours """
+    return {"fiches": {}, "en_vol": set(), "verrou": threading.Lock()}
+
+def _rafraichir_fiche(cle, echeance=None):
+    """
+    Fiche depuis le portail (budget court, borné par l'échéance du chargement appelant) ;
+    un échec est noté, jamais gardé à la place de la fiche
+    """
+    base_url, api_id = cle
+    registre = registre_fiches()
+    limite = time.monotonic() + BUDGET_METADONNEES
+    try:
+        r = requete_http(f"{base_url}/{api_id}", echeance=limite if echeance is None else min(limite, echeance))
+        if r.status_code != 200: raise PortailIndisponible(f"{api_id} : fiche en erreur {r.status_code}")
+        meta = r.json()
+        ecrire_cache_disque(base_url, api_id, VARIANTE_FICHE, meta)
+        fiche = {"meta": meta, "charge_le": time.time(), "echec_le": None}
+    except Exception:
+        fiche = None
+    with registre["verrou"]:
+        registre["en_vol"].discard(cle)
+        if fiche is not None:
+            registre["fiches"][cle] = fiche
+        else:
+            registre["fiches"].setdefault(cle, {"meta": None, "charge_le": None, "echec_le": None})["echec_le"] = time.time()
+
+def charger_metadonnees(base_url, api_id, echeance=None):
+    """
+    Fiche du jeu de données (schéma 'fields' + 'metas').
+    - fiche à jour : servie directement
+    - fiche périmée : servie tout de suite, UN rafraîchissement part en arrière-plan
+    - rien en mémoire : copie disque, sinon portail (avant echeance) ; PortailIndisponible si rien n'est lisible
+    """
+    cle = (base_url, api_id)
+    registre = registre_fiches()
+    maintenant = time.time()
+    with registre["verrou"]:
+        fiche = registre["fiches"].get(cle)
+        echec_recent = bool(fiche and fiche["echec_le"] and maintenant - fiche["echec_le"] < PAUSE_ECHEC_METADONNEES)
+        a_rafraichir = bool(fiche and fiche["meta"] is not None and not echec_recent and cle not in registre["en_vol"]
+                            and maintenant - fiche["charge_le"] >= TTL_METADONNEES)
+        if a_rafraichir: registre["en_vol"].add(cle)
+    if fiche is not None and fiche["meta"] is not None:
+        if a_rafraichir: registre_donnees()["pool"].submit(_rafraichir_fiche, cle)
+        return fiche["meta"]
+    if echec_recent: raise PortailIndisponible(f"{api_id} : fiche indisponible")
+
+    copie = lire_cache_disque(base_url, api_id, VARIANTE_FICHE)
+    if copie is not None:
+        # Même périmée, la copie disque garde le select= (et donc les clés de cache) stable
+        with registre["verrou"]:
+            fiche = registre["fiches"].get(cle)
+            if fiche is None or fiche["meta"] is None:
+                registre["fiches"][cle] = {"meta": copie["lignes"], "charge_le": copie["charge_le"], "echec_le": None}
+        return charger_metadonnees(base_url, api_id, echeance)
+    _rafraichir_fiche(cle, echeance)
+    with registre["verrou"]:
+        fiche = registre["fiches"].get(cle)
+    if fiche is None or fiche["meta"] is None: raise PortailIndisponible(f"{api_id} : fiche indisponible")
+    return fiche["meta"]
+
+def champs_utiles(config_data):
+    """ Colonnes réellement lues par la carte, les stats et l'export (précalculées par le catalogue) """
+    if "champs" in config_data: return list(config_data["champs"])
+    champs = [config_data.get("col_titre"), config_data.get("col_adresse"), config_data.get("image_col")]
+    champs += [k for k, _ in config_data.get("infos_sup", [])]
+    champs += config_data.get("champs_sup", [])
+    champs += CHAMPS_COORDONNEES + COLONNES_CP_A_SCANNER + COLONNES_INSEE + COLONNES_COMMUNE
+    return list(dict.fromkeys(c for c in champs if c))
+
+def construire_select(base_url, config_data):
+    """
+    Projection select= déduite de la config de la catégorie.
+    On ne garde que les champs présents dans le schéma (sinon l'API répond 400).
+    None = pas de projection (schéma inconnu).
+    """
+    try: meta = charger_metadonnees(base_url, config_data["api_id"])
+    except PortailIndisponible: return None
+    schema = {f.get("name") for f in meta.get("fields", [])}
+    if not schema: return None
+    champs = [c for c in champs_utiles(config_data) if c in schema]
+    return ",".join(champs) if champs else None
+
+def version_jeu(base_url, api_id, strict=False, echeance=None):
+    """ Date de dernière modification annoncée par le portail ("" si inconnue ; strict : fiche illisible -> exception) """
+    try: metas = charger_metadonnees(base_url, api_id, echeance).get("metas", {}).get("default", {})
+    except PortailIndisponible:
+        if strict: raise
+        return ""
+    return str(metas.get("data_processed") or metas.get("modified") or "")
+
+# --- CACHE DISQUE (SQLite) ---
+@st.cache_resource(show_spinner=False)
+def base_cache_disque():
+    """ Connexion SQLite partagée par le process (+ verrou, la connexion n'est pas thread-safe) """
+    os.makedirs(DOSSIER_CACHE, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(DOSSIER_CACHE, "jeux.sqlite"), check_same_thread=False)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jeux (
+            api_url TEXT, api_id TEXT, variante TEXT,
+            charge_le REAL, version TEXT, taille INTEGER, lu_le REAL, donnees BLOB,
+            PRIMARY KEY (api_url, api_id, variante)
+        )""")
+    # Validateurs HTTP de la fiche du jeu (revalidation conditionnelle)
+    colonnes = {c[1] for c in conn.execute("PRAGMA table_info(jeux)")}
+    for col in ("etag", "last_modified"):
+        if col not in colonnes: conn.execute(f"ALTER TABLE jeux ADD COLUMN {col} TEXT")
+    conn.commit()
+    return {"conn": conn, "verrou": threading.Lock()}
+
+def lire_cache_disque(api_url, api_id, variante):
+    """ Entrée {lignes, charge_le, version, etag, last_modified} ou None """
+    base = base_cache_disque()
+    try:
+        with base["verrou"]:
+            ligne = base["conn"].execute(
+                "SELECT charge_le, version, donnees, etag, last_modified FROM jeux WHERE api_url=? AND api_id=? AND variante=?",
+                (api_url, api_id, variante)).fetchone()
+            if ligne is None: return None
+            base["conn"].execute("UPDATE jeux SET lu_le=? WHERE api_url=? AND api_id=? AND variante=?",
+                                 (time.time(), api_url, api_id, variante))
+            base["conn"].commit()
+        return {"charge_le": ligne[0], "version": ligne[1], "etag": ligne[3] or "",
+                "last_modified": ligne[4] or "", "lignes": json.loads(zlib.decompress(ligne[2]))}
+    except Exception:
+        return None
+
+def ecrire_cache_disque(api_url, api_id, variante, lignes, version="", etag="", last_modified=""):
+    base = base_cache_disque()
+    donnees = zlib.compress(json.dumps(lignes).encode("utf-8"))
+    maintenant = time.time()
+    try:
+        with base["verrou"]:
+            base["conn"].execute(
+                """INSERT OR REPLACE INTO jeux
+                   (api_url, api_id, variante, charge_le, version, taille, lu_le, donnees, etag, last_modified)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (api_url, api_id, variante, maintenant, version, len(donnees), maintenant, donnees, etag, last_modified))
+            base["conn"].commit()
+        evincer_cache_disque()
+    except Exception:
+        pass
+
+def toucher_cache_disque(api_url, api_id, variante, etag="", last_modified=""):
+    """ Jeu inchangé côté portail : on repart pour une période sans retélécharger """
+    base = base_cache_disque()
+    try:
+        with base["verrou"]:
+            base["conn"].execute(
+                """UPDATE jeux SET charge_le=?, etag=COALESCE(NULLIF(?, ''), etag),
+                   last_modified=COALESCE(NULLIF(?, ''), last_modified)
+                   WHERE api_url=? AND api_id=? AND variante=?""",
+                (time.time(), etag, last_modified, api_url, api_id, variante))
+            base["conn"].commit()
+    except Exception:
+        pass
+
+def evincer_cache_disque(taille_max=TAILLE_MAX_CACHE_DISQUE):
+    """ Supprime les entrées les moins récemment lues tant que le total dépasse taille_max """
+    base = base_cache_disque()
+    with base["verrou"]:
+        conn = base["conn"]
+        total = conn.execute("SELECT COALESCE(SUM(taille), 0) FROM jeux").fetchone()[0]
+        if total <= taille_max: return
+        for api_url, api_id, variante, taille in conn.execute(
+                "SELECT api_url, api_id, variante, taille FROM jeux ORDER BY lu_le ASC").fetchall():
+            if total <= taille_max: break
+            conn.execute("DELETE FROM jeux WHERE api_url=? AND api_id=? AND variante=?", (api_url, api_id, variante))
+            total -= taille
+        conn.commit()
+
+def lister_cache_disque():
+    """ Contenu du cache disque (pour l'inspection dans la sidebar) """
+    base = base_cache_disque()
+    with base["verrou"]:
+        lignes = base["conn"].execute(
+            "SELECT api_id, variante, charge_le, version, taille, lu_le FROM jeux ORDER BY taille DESC").fetchall()
+    return [{"api_id": a, "variante": v, "version": ver, "taille (Ko)": round(t / 1024, 1),
+             "chargé le": time.strftime("%d/%m %H:%M", time.localtime(c)),
+             "lu le": time.strftime("%d/%m %H:%M", time.localtime(l))}
+            for a, v, c, ver, t, l in lignes]
+
+def purger_cache_disque(api_id=None):
+    """ Vide tout le cache disque, ou seulement les entrées d'un api_id """
+    base = base_cache_disque()
+    with base["verrou"]:
+        if api_id: base["conn"].execute("DELETE FROM jeux WHERE api_id=?", (api_id,))
+        else: base["conn"].execute("DELETE FROM jeux")
+        base["conn"].commit()
+        base["conn"].execute("VACUUM")
+
+# --- POLITIQUE DE RAFRAÎCHISSEMENT ---
+def duree_fraicheur(config_data):
+    """ Durée de validité en secondes (None = statique) """
+    politique = config_data.get("rafraichissement", POLITIQUE_PAR_DEFAUT)
+    if isinstance(politique, (int, float)): return politique
+    return POLITIQUES_RAFRAICHISSEMENT.get(politique, TTL_DONNEES)
+
+def tranche(instant, duree):
+    """ Période de rafraîchissement d'un instant : le jeton mémoire et le cache disque expirent ensemble """
+    return int(instant // duree)
+
+def est_frais(entree, duree, version):
+    """ Une copie en cache est-elle encore valable pour cette politique ? """
+    if duree is None:
+        if version: return entree["version"] == version
+        duree = POLITIQUES_RAFRAICHISSEMENT["quotidien"]  # Portail muet sur la date : 1 fois par jour
+    # Même période que le jeton : une copie de la période précédente n'est jamais resservie
+    return tranche(entree["charge_le"], duree) == tranche(time.time(), duree)
+
+def jeton_fraicheur(base_url, api_id, duree):
+    """ Clé de fraîcheur du cache mémoire : change dès que la donnée doit être rechargée """
+    if duree is None:
+        try:
+            version = version_jeu(base_url, api_id, strict=True)
+        except PortailIndisponible:
+            # Fiche injoignable : on garde la version de la copie en mémoire plutôt que le jeton du jour
+            version, jeton = "", jeton_en_memoire(base_url, api_id)
+            if jeton: return jeton
+        if version: return f"v:{version}"
+        duree = POLITIQUES_RAFRAICHISSEMENT["quotidien"]
+    return f"t:{tranche(time.time(), duree)}"
+
+def jeton_en_memoire(base_url, api_id):
+    """ Jeton de version ("v:...") d'une copie de ce jeu déjà en mémoire, None sinon """
+    registre = registre_donnees()
+    with registre["verrou"]:
+        for cle, entree in registre["entrees"].items():
+            if cle[:2] == (base_url, api_id) and str(entree["jeton"]).startswith("v:"):
+                return entree["jeton"]
+    return None
+
+def revalider(base_url, api_id, entree, echeance=None):
+    """
+    Revalidation à bas coût d'une copie expirée : GET conditionnel sur la fiche du jeu
+    (If-None-Match / If-Modified-Since), puis comparaison de data_processed/modified.
+    echeance : celle du chargement, que la revalidation entame comme le reste.
+    """
+    verdict = {"inchange": False, "version": "", "etag": "", "last_modified": ""}
+    headers = {}
+    if entree.get("etag"): headers["If-None-Match"] = entree["etag"]
+    if entree.get("last_modified"): headers["If-Modified-Since"] = entree["last_modified"]
+    try:
+        r = requete_http(f"{base_url}/{api_id}", headers=headers, echeance=echeance)
+    except Exception:
+        return verdict
+    verdict["etag"] = r.headers.get("ETag", "")
+    verdict["last_modified"] = r.headers.get("Last-Modified", "")
+    if r.status_code == 304:
+        verdict["inchange"] = True
+        verdict["version"] = entree["version"]
+    elif r.status_code == 200:
+        try: metas = r.json().get("metas", {}).get("default", {})
+        except ValueError: metas = {}
+        verdict["version"] = str(metas.get("data_processed") or metas.get("modified") or "")
+        verdict["inchange"] = bool(verdict["version"]) and verdict["version"] == entree["version"]
+    return verdict
+
+def rafraichir_jeu(base_url, api_id, cible, mode, select, duree, where=None):
+    """
+    Chargement "froid" : disque, puis revalidation, puis réseau.
+    mode = "pages" (/records, plafonné à cible) ou "export" (jeu complet en flux).
+    where = filtre ODSQL appliqué par le portail (recherche serveur).
+    Renvoie (lignes, partiel) ; le tout tient dans BUDGET_CHARGEMENT secondes.
+    """
+    echeance = time.monotonic() + BUDGET_CHARGEMENT
+    variante = f"{mode}|{cible}|{select or '*'}" + (f"|{where}" if where else "")
+    entree = lire_cache_disque(base_url, api_id, variante)
+    if entree and est_frais(entree, duree, version_jeu(base_url, api_id, echeance=echeance) if duree is None else ""):
+        return entree["lignes"], False
+
+    # Copie expirée : on demande d'abord au portail si le jeu a bougé (sauf flux rapides : on recharge)
+    revalidable = duree is None or duree >= DUREE_MIN_REVALIDATION
+    verdict = revalider(base_url, api_id, entree, echeance) if entree and revalidable else None
+    if verdict and verdict["inchange"]:
+        toucher_cache_disque(base_url, api_id, variante, verdict["etag"], verdict["last_modified"])
+        return entree["lignes"], False
+
+    params_sup = {k: v for k, v in {"select": select, "where": where}.items() if v} or None
+    if mode == "export":
+        resultats, partiel = charger_export(base_url, api_id, params_sup=params_sup, echeance=echeance)
+    else:
+        resultats, partiel = recuperer_pages(f"{base_url}/{api_id}/records", cible, params_sup, echeance)
+    if partiel and entree:
+        return entree["lignes"], False  # Portail en difficulté : la dernière copie complète vaut mieux
+    if resultats and not partiel:
+        if verdict: version, etag, lm = verdict["version"], verdict["etag"], verdict["last_modified"]
+        else: version, etag, lm = version_jeu(base_url, api_id, echeance=echeance), "", ""
+        ecrire_cache_disque(base_url, api_id, variante, resultats, version, etag, lm)
+    return resultats, partiel
+
+# --- CACHE MÉMOIRE PARTAGÉ (stale-while-revalidate + single-flight) ---
+@st.cache_resource(show_spinner=False)
+def registre_donnees():
+    """ Jeux en mémoire communs à toutes les sessions + chargements en cours par clé """
+    return {
+        "entrees": {},   # cle -> {"lignes", "partiel", "jeton", "charge_le", "derives"}
+        "en_vol": {},    # cle -> Future du chargement en cours
+        "verrou": threading.Lock(),
+        "pool": ThreadPoolExecutor(max_workers=4, thread_name_prefix="rafraichir"),
+    }
+
+def figer(lignes):
+    """ Copie unique et en lecture seule d'un jeu, partagée telle quelle par toutes les sessions """
+    return tuple(MappingProxyType(l) if isinstance(l, dict) else l for l in lignes)
+
+def derive(entree, nom, fabrique):
+    """
+    Calcul dérivé d'un jeu (tableau, index, coordonnées...) : fait une fois par version,
+    puis servi à toutes les sessions. Une nouvelle version = nouvelle entrée = nouveaux dérivés.
+    """
+    derives = entree["derives"]
+    if nom not in derives:
+        derives[nom] = fabrique(entree["lignes"])  # Au pire deux sessions calculent la même chose
+    return derives[nom]
+
+def tableau_jeu(entree):
+    """ Vue colonnes (DataFrame) du jeu brut, construite une seule fois : ne pas la modifier """
+    return derive(entree, "tableau", lambda lignes: pd.DataFrame([dict(l) for l in lignes]))
+
+# --- TABLE NORMALISÉE (titre, adresse, infos, image, lat/lon, CP) ---
+def _typer_colonne(valeurs):
+    """
+    Numérique si possible (entier nullable quand toutes les valeurs sont entières),
+    sinon catégorielle si peu de valeurs distinctes, sinon texte. Les valeurs sont gardées telles quelles (0, False...).
+    """
+    serie = pd.Series(valeurs, dtype=object)
+    non_vides = serie[serie.notna() & (serie != "")]
+    if non_vides.empty: return serie.astype("string")
+    nombres = pd.to_numeric(non_vides, errors="coerce")
+    # Pas de booléens, ni de codes à zéro initial ("06...", "0123") qui perdraient ce zéro
+    if (nombres.notna().all() and not non_vides.map(lambda v: isinstance(v, bool)).any()
+            and not non_vides.map(lambda v: isinstance(v, str) and re.match(r"\s*0\d", v) is not None).any()):
+        nombres = pd.to_numeric(serie.where(serie != "", None), errors="coerce")
+        if (nombres.dropna() % 1 == 0).all() and nombres.abs().max() < 2 ** 53: return nombres.astype("Int64")
+        return nombres
+    serie = serie.map(lambda v: None if v is None else str(v))
+    if non_vides.nunique() <= max(1, len(non_vides) // 2): return serie.astype("category")
+    return serie.astype("string")
+
+def construire_table(lignes, coords, cp, config_ville, config_data):
+    """ Une ligne par enregistrement (même ordre que le jeu), colonnes typées et compactes """
+    titres, adresses, images = [], [], []
+    for site in lignes:
+        titres.append(str(site.get(config_data["col_titre"]) or "Lieu").replace('"', ''))
+        adresses.append(str(site.get(config_data["col_adresse"]) or ""))
+        url_img = site.get(config_data["image_col"]) if "image_col" in config_data else None
+        if isinstance(url_img, dict): url_img = url_img.get("url")
+        images.append(url_img or None)
+
+    table = pd.DataFrame({
+        "titre": pd.Series(titres, dtype="category"),
+        "adresse": pd.Series(adresses, dtype="category"),
+        "image": pd.Series(images, dtype=object),
+        "lat": np.where(coords["valide"], coords["lat"], np.nan).astype(np.float32),
+        "lon": np.where(coords["valide"], coords["lon"], np.nan).astype(np.float32),
+        "cp": pd.Series(cp, dtype=object).reset_index(drop=True).astype("category"),
+    })
+    for k, _ in config_data["infos_sup"]:
+        table[f"info_{k}"] = _typer_colonne([site.get(k) for site in lignes])
+    return table
+
+def _cle_table(config_ville, config_data):
+    return (config_ville["cp_prefix"], config_data["col_titre"], config_data["col_adresse"],
+            config_data.get("image_col"), tuple(k for k, _ in config_data["infos_sup"]))
+
+def table_jeu(entree, config_ville, config_data):
+    """ Table normalisée d'une catégorie, construite une fois par version du jeu """
+    cle = ("table",) + _cle_table(config_ville, config_data)
+    return derive(entree, cle, lambda lignes: construire_table(
+        lignes, coordonnees_jeu(entree), resoudre_cp(tableau_jeu(entree), config_ville, config_data), config_ville, config_data))
+
+def table_pour_export(table, config_data, libelle_cp="CP"):
+    """ Colonnes lisibles pour le CSV / le tableau de l'onglet Données """
+    noms = {"titre": "Nom", "adresse": "Adresse", "image": "Image", "lat": "Latitude", "lon": "Longitude", "cp": libelle_cp}
+    noms.update({f"info_{k}": label for k, label in config_data["infos_sup"]})
+    colonnes = [c for c in noms if c in table.columns and (c != "image" or "image_col" in config_data)]
+    return table[colonnes].rename(columns=noms)
+
+def _texte_info(val):
+    """ Valeur affichée dans une bulle : les vides (None, "", 0, False) n'y figurent pas """
+    if val is None or pd.isna(val) or not val: return None
+    val = str(val)
+    return val[:100] + "..." if len(val) > 100 else val
+
+def donnees_marqueurs(table, positions):
+    """ Charge utile compacte de la carte : [lat, lon, titre, adresse, image, info_1, ...] par lieu """
+    vue = table.iloc[positions]
+    colonnes = [vue["lat"].to_numpy(np.float64).round(6).tolist(), vue["lon"].to_numpy(np.float64).round(6).tolist(),
+                vue["titre"].tolist(), vue["adresse"].tolist(), vue["image"].tolist()]
+    colonnes += [[_texte_info(v) for v in vue[c].tolist()] for c in vue.columns if c.startswith("info_")]
+    return [list(ligne) for ligne in zip(*colonnes)]
+
+def callback_marqueurs(config_data):
+    """ Fonction JS (FastMarkerCluster) : marqueur + bulle construits par le navigateur """
+    labels = json.dumps([label for _, label in config_data["infos_sup"]], ensure_ascii=False)
+    icone = json.dumps({"icon": config_data["icone"], "markerColor": config_data["couleur"], "prefix": "fa"})
+    return f"""function (row) {{
+        var labels = {labels};
+        var html = row[4] ? '<img src="' + row[4] + '" width="200px" style="border-radius:5px; margin-bottom:10px;"><br>' : '';
+        html += '<b>' + row[2] + '</b><br><i>' + row[3] + '</i><br>'
+            + '<a href="https://www.google.com/maps/dir/?api=1&destination=' + row[0] + ',' + row[1] + '" target="_blank" style="text-decoration:none;">'
+            + '<button style="margin-top:5px;cursor:pointer;">📍 Y aller</button></a>';
+        for (var i = 0; i < labels.length; i++) {{
+            if (row[5 + i] !== null) html += '<br><b>' + labels[i] + ':</b> ' + row[5 + i];
+        }}
+        var marker = L.marker(new L.LatLng(row[0], row[1]), {{icon: L.AwesomeMarkers.icon({icone})}});
+        marker.bindPopup(html, {{maxWidth: 250}});
+        return marker;
+    }}"""
+
+FONDS_CARTE = {
+    "Clair (Défaut)": ("OpenStreetMap", None),
+    "Sombre (Nuit)": ("CartoDB dark_matter", "CartoDB"),
+    "Satellite": ("https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", "Esri"),
+}
+
+def calque_carte(config_ville, config_data, table, positions, style_vue):
+    """
+    Couche principale de la carte (marqueurs ou densité), la partie coûteuse : préparée une fois
+    par carte en cache, folium y valide les points à la construction. None pour un simple fond de plan.
+    """
+    if style_vue == "📍 Points":
+        # Un seul tableau de données + une fonction JS, au lieu d'un objet Python par marqueur
+        return FastMarkerCluster(donnees_marqueurs(table, positions), callback=callback_marqueurs(config_data))
+    if style_vue == "🔥 Densité" and len(positions):
+        zoom = config_ville["zoom_start"]
+        lat, lon, poids = agreger_par_grille(table["lat"].to_numpy(np.float64)[positions], table["lon"].to_numpy(np.float64)[positions],
+                                             zoom, TAILLE_CASE_DENSITE_PX)
+        return couche_densite(lat, lon, poids, zoom)
+    return None
+
+def construire_carte(config_ville, fond_carte, calque=None):
+    """
+    Carte folium neuve : fond de plan + copie du calque préparé. Le rendu modifie la carte
+    (scripts, enfants ajoutés par st_folium) : une carte ne sert donc qu'une fois.
+    """
+    tiles, attr = FONDS_CARTE[fond_carte]
+    m = folium.Map(location=config_ville["coords_center"], zoom_start=config_ville["zoom_start"], tiles=tiles, attr=attr)
+    if calque is not None:
+        # Copie sans parent ni enfants : mêmes données déjà validées, rien n'est recalculé
+        copie = copy.copy(calque)
+        copie._parent, copie._children = None, OrderedDict()
+        copie.add_to(m)
+    return m
+
+def carte_en_cache(cle, config_ville, fond_carte, preparer_calque):
+    """
+    Calque de la carte de la session, préparé seulement quand cle change
+    (ville, catégorie, vue, fond, filtre, version du jeu...). Chaque affichage part d'une carte neuve.
+    """
+    cache = st.session_state.get("carte_en_cache")
+    if cache is None or cache["cle"] != cle:
+        calque = preparer_calque()
+        cache = {"cle": cle, "fabrique": lambda: construire_carte(config_ville, fond_carte, calque), "html": None,
+                 "verrou": threading.Lock()}
+        st.session_state.carte_en_cache = cache
+    return cache
+
+def afficher_carte(cache, couches, cle, retours):
+    """ st_folium sur une carte neuve (calque en cache), avec les couches dynamiques (zone visible, repère) """
+    return st_folium(cache["fabrique"](), width=1000, height=600, key=cle,
+                     feature_group_to_add=couches or None, returned_objects=retours)
+
+def html_carte(cache, fabrique=None):
+    """ HTML téléchargeable : rendu d'une carte neuve au premier clic sur le bouton, puis gardé avec le calque """
+    with cache["verrou"]:
+        if cache["html"] is None:
+            cache["html"] = (fabrique or cache["fabrique"])().get_root().render()
+        return cache["html"]
+
+def _executer_chargement(cle, jeton, futur, base_url, api_id, cible, mode, select, duree, where):
+    registre = registre_donnees()
+    try:
+        lignes, partiel = rafraichir_jeu(base_url, api_id, cible, mode, select, duree, where)
+        # Jeu partiel : pas de jeton, la prochaine lecture relance un chargement en arrière-plan
+        entree = {"lignes": figer(lignes), "partiel": partiel, "jeton": None if partiel else jeton,
+                  "charge_le": time.time(), "derives": {}}
+        with registre["verrou"]:
+            registre["entrees"][cle] = entree
+            while len(registre["entrees"]) > MAX_JEUX_EN_MEMOIRE:
+                plus_ancien = min(registre["entrees"], key=lambda c: registre["entrees"][c]["charge_le"])
+                del registre["entrees"][plus_ancien]
+        futur.set_result(entree)
+    except Exception as e:
+        futur.set_exception(e)
+    finally:
+        with registre["verrou"]:
+            registre["en_vol"].pop(cle, None)
+
+def _lancer_chargement(cle, jeton, args, en_arriere_plan):
+    """ Un seul chargement par clé : les demandes concurrentes rejoignent celui en cours """
+    registre = registre_donnees()
+    with registre["verrou"]:
+        futur = registre["en_vol"].get(cle)
+        if futur is not None: return futur, False
+        futur = Future()
+        registre["en_vol"][cle] = futur
+    if en_arriere_plan:
+        registre["pool"].submit(_executer_chargement, cle, jeton, futur, *args)
+    else:
+        _executer_chargement(cle, jeton, futur, *args)
+    return futur, True
+
+def charger_jeu(base_url, api_id, cible=500, mode="pages", select=None, duree=TTL_DONNEES, jeton=None, where=None):
+    """
+    Point d'entrée des données : {"lignes", "partiel", ...}
+    (partagé entre sessions : ne pas le modifier).
+    - copie à jour (même jeton de fraîcheur) : servie directement
+    - copie périmée : servie tout de suite, UN rafraîchissement part en arrière-plan
+    - rien en mémoire : on charge, ou on attend le chargement déjà lancé pour cette clé
+    """
+    registre = registre_donnees()
+    cle = (base_url, api_id, mode, cible, select, where)
+    args = (base_url, api_id, cible, mode, select, duree, where)
+    with registre["verrou"]:
+        entree = registre["entrees"].get(cle)
+    if entree is not None:
+        if entree["jeton"] != jeton:
+            _lancer_chargement(cle, jeton, args, en_arriere_plan=True)
+        return entree
+    futur, _ = _lancer_chargement(cle, jeton, args, en_arriere_plan=False)
+    try: return futur.result()
+    except Exception: return {"lignes": (), "partiel": True, "jeton": None, "charge_le": time.time(), "derives": {}}
+
+def garder_au_chaud(base_url, api_id, cible=500, mode="pages", select=None, duree=TTL_DONNEES, jeton=None, where=None):
+    """ Recharge (en attendant la fin) si la copie mémoire est absente ou périmée ; None si déjà fraîche """
+    registre = registre_donnees()
+    cle = (base_url, api_id, mode, cible, select, where)
+    with registre["verrou"]:
+        entree = registre["entrees"].get(cle)
+    if entree is not None and entree["jeton"] == jeton: return None
+    futur, _ = _lancer_chargement(cle, jeton, (base_url, api_id, cible, mode, select, duree, where), en_arriere_plan=False)
+    return futur.result()
+
+def vider_registre_donnees():
+    registre = registre_donnees()
+    with registre["verrou"]:
+        registre["entrees"].clear()
+    fiches = registre_fiches()
+    with fiches["verrou"]:
+        fiches["fiches"].clear()
+
+def requete_odsql(recherche):
+    """
+    'Recherche zone' -> clause where ODSQL : un search() par mot (ET logique).
+    Les mots sont normalisés (minuscules, sans accents) : une seule entrée de cache par requête.
+    """
+    mots = tokeniser(recherche)
+    if not mots: return None
+    return " AND ".join(f'search("{mot}")' for mot in mots)
+
+def parametres_categorie(config_ville, config_data, complet=False, recherche=None):
+    """
+    Arguments de charger_jeu pour une catégorie.
+    complet=True : toutes les colonnes ; recherche : filtre texte exécuté par le portail.
+    """
+    limit_req = 1000 if "frequentation" in config_data["api_id"] else 600
+    select = None if complet else construire_select(config_ville["api_url"], config_data)
+    duree = duree_fraicheur(config_data)
+    return {"base_url": config_ville["api_url"], "api_id": config_data["api_id"], "cible": limit_req,
+            "mode": config_data.get("mode_chargement", "pages"), "select": select, "duree": duree,
+            "jeton": jeton_fraicheur(config_ville["api_url"], config_data["api_id"], duree),
+            "where": requete_odsql(recherche) if recherche else None}
+
+def charger_categorie(config_ville, config_data, complet=False, recherche=None):
+    """ Jeu d'une catégorie selon sa config """
+    return charger_jeu(**parametres_categorie(config_ville, config_data, complet, recherche))
+
+# --- PRÉCHAUFFAGE EN ARRIÈRE-PLAN (1 planificateur par process serveur) ---
+@st.cache_resource(show_spinner=False)
+def planificateur_prechauffage():
+    """ Démarre le thread qui garde toutes les catégories de CONFIG_VILLES au chaud """
+    etat = {"taches": {}, "verrou": threading.Lock(), "demarre_le": time.time(),
+            "dernier_passage": None, "erreur_passage": "",
+            "actif": os.environ.get("CITYPULSE_PRECHAUFFAGE", "1") != "0"}
+    if etat["actif"]:
+        threading.Thread(target=_boucle_prechauffage, args=(etat,), daemon=True, name="prechauffage").start()
+        threading.Thread(target=prechauffer_voix, daemon=True, name="prechauffage_voix").start()
+    return etat
+
+@st.cache_resource(show_spinner=False)
+def semaphores_hotes():
+    return {"semaphores": {}, "verrou": threading.Lock()}  # hôte -> jeux chargés en même temps sur ce portail
+
+def semaphore_hote(url):
+    """ Limite commune (préchauffage, labo...) de chargements simultanés par portail """
+    limites, hote = semaphores_hotes(), urlparse(url).netloc
+    with limites["verrou"]:
+        return limites["semaphores"].setdefault(hote, threading.BoundedSemaphore(PRECHAUFFAGE_PAR_HOTE))
+
+def _boucle_prechauffage(etat):
+    pool = ThreadPoolExecutor(max_workers=PRECHAUFFAGE_WORKERS, thread_name_prefix="prechauffage")
+    while True:
+        # Une erreur imprévue ne doit pas tuer le thread : on la note et on repasse plus tard
+        try:
+            _passe_prechauffage(etat, pool)
+            erreur = ""
+        except Exception as e:
+            journal.exception("Préchauffage : passage en échec")
+            erreur = str(e) or type(e).__name__
+        with etat["verrou"]:
+            etat["dernier_passage"], etat["erreur_passage"] = time.time(), erreur
+        time.sleep(PERIODE_PRECHAUFFAGE)
+
+def _passe_prechauffage(etat, pool):
+    """ Un passage : chaque catégorie qui n'est pas déjà en cours part dans le pool """
+    for ville_nom, config_ville in CONFIG_VILLES.villes_valides():
+        semaphore = semaphore_hote(config_ville["api_url"])
+        for cat_nom, config_data in config_ville["categories"].items():
+            if config_data.get("api_id") == "custom_meteo": continue
+            cle = (ville_nom, cat_nom)
+            with etat["verrou"]:
+                tache = etat["taches"].setdefault(cle, {
+                    "dernier_rafraichissement": None, "duree": None, "lignes": None,
+                    "erreur": "", "en_cours": False})
+                if tache["en_cours"]: continue
+                tache["en_cours"] = True
+            pool.submit(_prechauffer, etat, cle, config_ville, config_data, semaphore)
+    rafraichir_meteo()
+
+def _prechauffer(etat, cle, config_ville, config_data, semaphore):
+    debut = time.monotonic()
+    entree, erreur = None, ""
+    try:
+        with semaphore:
+            entree = garder_au_chaud(**parametres_categorie(config_ville, config_data))
+        if entree is not None and entree["partiel"]: erreur = "Chargement partiel"
+        # Catégories d'urgence : l'index spatial est prêt avant la première question "le plus proche"
+        if est_urgence(config_data):
+            index_spatial_jeu(charger_categorie(config_ville, config_data), config_ville, config_data)
+    except Exception as e:
+        erreur = str(e) or type(e).__name__
+    with etat["verrou"]:
+        tache = etat["taches"][cle]
+        tache["en_cours"] = False
+        if entree is not None or erreur:
+            tache["dernier_rafraichissement"] = time.time()
+            tache["duree"] = time.monotonic() - debut
+            tache["erreur"] = erreur
+            if entree is not None: tache["lignes"] = len(entree["lignes"])
+
+def secret_admin():
+    """ Secret de la vue admin : CITYPULSE_ADMIN, sinon admin_token de st.secrets (None = vue admin fermée) """
+    secret = os.environ.get("CITYPULSE_ADMIN")
+    if secret: return secret
+    try: return st.secrets.get("admin_token") or None
+    except Exception: return None  # Pas de secrets.toml
+
+def est_admin():
+    """ Vue admin ouverte par ?admin=<secret> (comparaison à temps constant) """
+    secret = secret_admin()
+    return bool(secret) and hmac.compare_digest(str(st.query_params.get("admin", "")).encode(), str(secret).encode())
+
+def statut_prechauffage():
+    """ Tableau de bord du planificateur (vue admin) """
+    etat = planificateur_prechauffage()
+    with etat["verrou"]:
+        taches = [(cle, dict(t)) for cle, t in etat["taches"].items()]
+    return [{"Ville": ville, "Catégorie": cat,
+             "Dernier rafraîchissement": time.strftime("%H:%M:%S", time.localtime(t["dernier_rafraichissement"])) if t["dernier_rafraichissement"] else "—",
+             "Durée (s)": round(t["duree"], 2) if t["duree"] is not None else None,
+             "Lignes": t["lignes"], "Erreur": t["erreur"], "En cours": t["en_cours"]}
+            for (ville, cat), t in taches]
+
+# --- INDEX TEXTE INVERSÉ (filtre "Recherche zone") ---
+RE_MOTS = re.compile(r"[a-z0-9]+")
+POIDS_CHAMPS = {"titre": 3, "adresse": 2, "cp": 2}  # Colonnes info_* : poids 1
+
+def replier_chaine(texte):
+    """ Minuscules sans accents ('Défibrillateur' -> 'defibrillateur') """
+    return unicodedata.normalize("NFKD", str(texte)).encode("ascii", "ignore").decode("ascii").lower()
+
+def tokeniser(texte):
+    return RE_MOTS.findall(replier_chaine(texte))
+
+def construire_index_texte(table):
+    """
+    mot -> (positions, poids du meilleur champ). Construit sur titre, adresse, CP et infos_sup
+    (et plus sur le repr des dicts : fini les correspondances sur les clés ou les URL).
+    """
+    colonnes = ["titre", "adresse", "cp"] + [c for c in table.columns if c.startswith("info_")]
+    postings = {}
+    for col in colonnes:
+        poids = POIDS_CHAMPS.get(col, 1)
+        deja_vus = {}  # Valeurs répétées (colonnes catégorielles) : tokenisées une seule fois
+        for i, val in enumerate(table[col].tolist()):
+            if val is None or val is pd.NA or (isinstance(val, float) and np.isnan(val)): continue
+            mots = deja_vus.get(val)
+            if mots is None: mots = deja_vus[val] = set(tokeniser(val))
+            for mot in mots:
+                lignes = postings.setdefault(mot, {})
+                if lignes.get(i, 0) < poids: lignes[i] = poids
+    return {
+        "vocabulaire": sorted(postings),
+        "postings": {mot: (np.fromiter(l.keys(), dtype=np.int64, count=len(l)),
+                           np.fromiter(l.values(), dtype=np.float64, count=len(l)))
+                     for mot, l in postings.items()},
+        "n": len(table),
+    }
+
+def index_texte_jeu(entree, config_ville, config_data):
+    """ Index du jeu, construit une fois par version """
+    cle = ("index_texte",) + _cle_table(config_ville, config_data)
+    return derive(entree, cle, lambda _: construire_index_texte(table_jeu(entree, config_ville, config_data)))
+
+def chercher_index(index, requete):
+    """
+    Positions des lignes contenant TOUS les mots de la requête (préfixes acceptés),
+    classées par pertinence : champ plus important et mot exact d'abord.
+    """
+    mots = tokeniser(requete)
+    if not mots: return []
+    vocabulaire, scores = index["vocabulaire"], None
+    for mot in mots:
+        score_mot = np.zeros(index["n"])
+        debut, fin = bisect_left(vocabulaire, mot), bisect_left(vocabulaire, mot + "{")  # '{' suit 'z'
+        for candidat in vocabulaire[debut:fin]:
+            lignes, poids = index["postings"][candidat]
+            np.maximum.at(score_mot, lignes, poids if candidat == mot else poids * 0.5)
+        scores = score_mot if scores is None else np.where((scores > 0) & (score_mot > 0), scores + score_mot, 0)
+    positions = np.flatnonzero(scores > 0)
+    return positions[np.argsort(-scores[positions], kind="stable")].tolist()
+
+# --- INDEX SPATIAL (grille) + "les plus proches" ---
+PAS_GRILLE_SPATIALE = 0.01  # degrés : cellules d'environ 1,1 km x 0,75 km
+RAYON_TERRE_M = 6371000
+MAX_MARQUEURS_VISIBLES = 300  # Au-delà, la carte progressive affiche des agrégats
+TAILLE_AGREGAT_PX = 60  # Côté (en pixels écran) d'une case d'agrégation
+TAILLE_CASE_DENSITE_PX = 6  # Côté d'une case de la carte de densité
+
+def est_urgence(config_data):
+    """ Catégories où le temps de réponse compte avant tout (défibrillateurs...) """
+    return "urgence" in config_data.get("mots_cles", [])
+
+def distances_m(lat, lon, lats, lons):
+    """ Distance haversine (mètres) d'un point vers un tableau de points """
+    p1, p2 = np.radians(lat), np.radians(lats)
+    dphi, dlambda = p2 - p1, np.radians(lons - lon)
+    a = np.sin(dphi / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dlambda / 2) ** 2
+    return 2 * RAYON_TERRE_M * np.arcsin(np.sqrt(a))
+
+def construire_index_spatial(table, pas=PAS_GRILLE_SPATIALE):
+    """ Cellule (i, j) de la grille -> positions des lieux qu'elle contient """
+    lat, lon = table["lat"].to_numpy(np.float64), table["lon"].to_numpy(np.float64)
+    valides = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    index = {"pas": pas, "lat": lat, "lon": lon, "cellules": {}}
+    if len(valides) == 0: return index
+    cles = np.stack([np.floor(lat[valides] / pas), np.floor(lon[valides] / pas)], axis=1).astype(np.int64)
+    uniques, inverse = np.unique(cles, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    groupes = np.split(valides[np.argsort(inverse, kind="stable")], np.cumsum(np.bincount(inverse))[:-1])
+    index["cellules"] = {(int(i), int(j)): g for (i, j), g in zip(uniques, groupes)}
+    index["bornes"] = (uniques[:, 0].min(), uniques[:, 0].max(), uniques[:, 1].min(), uniques[:, 1].max())
+    return index
+
+def index_spatial_jeu(entree, config_ville, config_data):
+    """ Index spatial du jeu, construit une fois par version """
+    cle = ("index_spatial",) + _cle_table(config_ville, config_data)
+    return derive(entree, cle, lambda _: construire_index_spatial(table_jeu(entree, config_ville, config_data)))
+
+def voisins(index, lat, lon, k=5, rayon_m=None, autorises=None):
+    """
+    k plus proches (et/ou dans un rayon) : on parcourt les anneaux de cellules autour du point
+    et on s'arrête dès qu'aucune cellule plus lointaine ne peut battre le k-ième trouvé.
+    autorises = masque booléen des lignes éligibles (filtre, disponibilité...).
+    Renvoie (positions, distances en m) triées par distance.
+    """
+    if not index["cellules"]: return np.array([], dtype=np.int64), np.array([])
+    pas = index["pas"]
+    ci, cj = int(np.floor(lat / pas)), int(np.floor(lon / pas))
+    # Distance minimale couverte par un anneau de cellules (côté le plus court)
+    taille_cellule_m = pas * 111320 * min(1.0, np.cos(np.radians(lat)))
+    cellules = index["cellules"]
+    imin, imax, jmin, jmax = index["bornes"]
+    anneau_min = int(max(0, imin - ci, ci - imax, jmin - cj, cj - jmax))  # Anneaux vides avant les données
+    anneau_max = int(max(abs(ci - imin), abs(ci - imax), abs(cj - jmin), abs(cj - jmax)))
+    if rayon_m is not None: anneau_max = min(anneau_max, int(np.ceil(rayon_m / taille_cellule_m)))
+
+    positions, distances = [], []
+    for r in range(anneau_min, anneau_max + 1):
+        if 8 * r >= len(cellules):
+            # L'anneau compte plus de cases que la grille n'a de cellules : on balaie le reste d'un coup
+            cles = [c for c in cellules if max(abs(c[0] - ci), abs(c[1] - cj)) >= r]
+        else:
+            cles = [(ci + di, cj + dj) for di in range(-r, r + 1) for dj in ((-r, r) if abs(di) != r else range(-r, r + 1))]
+        for cle in cles:
+            cellule = cellules.get(cle)
+            if cellule is None: continue
+            if autorises is not None: cellule = cellule[autorises[cellule]]
+            if len(cellule) == 0: continue
+            d = distances_m(lat, lon, index["lat"][cellule], index["lon"][cellule])
+            if rayon_m is not None:
+                cellule, d = cellule[d <= rayon_m], d[d <= rayon_m]
+            positions.append(cellule)
+            distances.append(d)
+        if 8 * r >= len(cellules): break
+        nb = sum(len(p) for p in positions)
+        if k and nb >= k and np.partition(np.concatenate(distances), k - 1)[k - 1] <= r * taille_cellule_m:
+            break
+    if not positions: return np.array([], dtype=np.int64), np.array([])
+    positions, distances = np.concatenate(positions), np.concatenate(distances)
+    ordre = np.argsort(distances, kind="stable")[:k] if k else np.argsort(distances, kind="stable")
+    return positions[ordre], distances[ordre]
+
+def plus_proches(entree, config_ville, config_data, lat, lon, k=5, rayon_m=None, positions=None, disponible=False):
+    """
+    Les k lieux d'une catégorie les plus proches d'un point (table normalisée + colonne distance_m).
+    positions : restreindre à un sous-ensemble (filtre actif) ;
+    disponible : seulement les lieux dont "col_disponibilite" est > 0 (vélos, places...).
+    """
+    table = table_jeu(entree, config_ville, config_data)
+    autorises = None
+    if positions is not None:
+        autorises = np.zeros(len(table), dtype=bool)
+        autorises[np.asarray(positions, dtype=int)] = True
+    col_dispo = f"info_{config_data.get('col_disponibilite')}"
+    if disponible and col_dispo in table.columns:
+        dispo = pd.to_numeric(table[col_dispo], errors="coerce").fillna(0).to_numpy() > 0
+        autorises = dispo if autorises is None else autorises & dispo
+    trouves, distances = voisins(index_spatial_jeu(entree, config_ville, config_data), lat, lon, k, rayon_m, autorises)
+    return table.iloc[trouves].assign(distance_m=distances.round(0))
+
+def emprise_renseignee(emprise):
+    """ Emprise st_folium avec de vraies coordonnées (celle d'une carte jamais affichée a des lat à None) """
+    emprise = emprise or {}
+    return (emprise.get("_southWest") or {}).get("lat") is not None and (emprise.get("_northEast") or {}).get("lat") is not None
+
+def dans_emprise(index, sud, ouest, nord, est):
+    """ Positions (triées) des lieux dans un rectangle, ex. l'emprise visible de la carte """
+    vide = np.array([], dtype=np.int64)
+    cellules = index["cellules"]
+    if not cellules: return vide
+    pas = index["pas"]
+    imin, imax, jmin, jmax = index["bornes"]
+    i0, i1 = max(imin, int(np.floor(sud / pas))), min(imax, int(np.floor(nord / pas)))
+    j0, j1 = max(jmin, int(np.floor(ouest / pas))), min(jmax, int(np.floor(est / pas)))
+    if i0 > i1 or j0 > j1: return vide
+    if (i1 - i0 + 1) * (j1 - j0 + 1) > len(cellules):
+        cles = [c for c in cellules if i0 <= c[0] <= i1 and j0 <= c[1] <= j1]
+    else:
+        cles = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+    morceaux = [cellules[c] for c in cles if c in cellules]
+    if not morceaux: return vide
+    positions = np.concatenate(morceaux)
+    lat, lon = index["lat"][positions], index["lon"][positions]
+    return np.sort(positions[(lat >= sud) & (lat <= nord) & (lon >= ouest) & (lon <= est)])
+
+def agreger_par_grille(lat, lon, zoom, taille_px=TAILLE_AGREGAT_PX):
+    """ Regroupe les points en cases d'environ taille_px pixels au zoom donné -> (lat moy., lon moy., effectif) """
+    if len(lat) == 0: return np.array([]), np.array([]), np.array([], dtype=np.int64)
+    pas = taille_px * 360 / (256 * 2 ** zoom)
+    cles = np.stack([np.floor(lat / pas), np.floor(lon / pas)], axis=1).astype(np.int64)
+    _, inverse, effectifs = np.unique(cles, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    return np.bincount(inverse, weights=lat) / effectifs, np.bincount(inverse, weights=lon) / effectifs, effectifs
+
+def densite_jeu(entree, config_ville, config_data, zoom, positions=None):
+    """
+    Carte de densité pré-agrégée au zoom donné -> (lat, lon, poids) par case.
+    Sans filtre, calculée une fois par version du jeu et par niveau de zoom.
+    """
+    table = table_jeu(entree, config_ville, config_data)
+    def calculer(_):
+        lat, lon = table["lat"].to_numpy(np.float64), table["lon"].to_numpy(np.float64)
+        retenus = np.flatnonzero(np.isfinite(lat)) if positions is None else np.asarray(positions, dtype=int)
+        return agreger_par_grille(lat[retenus], lon[retenus], zoom, TAILLE_CASE_DENSITE_PX)
+    if positions is not None: return calculer(None)
+    return derive(entree, ("densite", int(zoom)) + _cle_table(config_ville, config_data), calculer)
+
+def couche_densite(lat, lon, poids, zoom):
+    """ HeatMap à partir des cases agrégées (poids ramenés à [0, 1]) """
+    points = np.column_stack([lat, lon, poids / max(poids.max(), 1)]).round(6).tolist() if len(poids) else []
+    return HeatMap(points, radius=15, max_zoom=int(zoom))
+
+# --- LABO DE CORRÉLATIONS (comptes par zone, matrice) ---
+MIN_ZONES_CORRELATION = 3  # En dessous, une corrélation ne veut rien dire
+TTL_CORRELATIONS = 600  # Matrice d'une ville gardée (toutes sessions) avant d'être recalculée
+
+def compter_par_zone(table, par_cp=False, pas=PAS_GRILLE_SPATIALE):
+    """
+    Nombre de lieux par zone -> Series (libellé de zone -> nombre).
+    Zone = carré GPS de la grille (~1 km²) ; avec par_cp, le code postal d'abord quand il est connu.
+    """
+    lat, lon = table["lat"].to_numpy(np.float64), table["lon"].to_numpy(np.float64)
+    sur_grille = np.isfinite(lat) & np.isfinite(lon)
+    parties = []
+    if par_cp:
+        cp = table["cp"].astype(object)
+        avec_cp = cp.notna().to_numpy()
+        parties.append(cp[avec_cp].value_counts())
+        sur_grille &= ~avec_cp
+    i = np.round(lat[sur_grille] / pas).astype(np.int64)
+    j = np.round(lon[sur_grille] / pas).astype(np.int64)
+    cases, nombres = np.unique(np.column_stack([i, j]), axis=0, return_counts=True)
+    libelles = [f"Zone GPS {a * pas:.2f}/{b * pas:.2f}" for a, b in cases.tolist()]
+    parties.append(pd.Series(nombres, index=libelles))
+    comptes = pd.concat(parties)
+    return comptes[comptes > 0].astype(np.int64)
+
+def comptes_zones_jeu(entree, config_ville, config_data):
+    """ Comptes par zone d'une catégorie, calculés une fois par version du jeu """
+    par_cp = config_ville.get("zonage") == "cp"
+    table = table_jeu(entree, config_ville, config_data)
+    return derive(entree, ("zones", par_cp) + _cle_table(config_ville, config_data),
+                  lambda _: compter_par_zone(table, par_cp))
+
+def categories_correlables(config_ville):
+    """ Catégories qui ont des lieux (pas la météo ni les courbes) """
+    return [c for c, conf in config_ville["categories"].items()
+            if conf.get("api_id") != "custom_meteo" and "Meteo" not in c and "Courbe" not in c]
+
+def comptes_zones_ville(config_ville, categories):
+    """ {catégorie: comptes par zone}, jeux chargés en parallèle dans la limite du portail """
+    semaphore = semaphore_hote(config_ville["api_url"])
+    def comptes(cat):
+        conf = config_ville["categories"][cat]
+        with semaphore:
+            jeu = charger_categorie(config_ville, conf)
+        return comptes_zones_jeu(jeu, config_ville, conf)
+    with ThreadPoolExecutor(max_workers=NB_REQUETES_PARALLELES, thread_name_prefix="correlations") as pool:
+        return dict(zip(categories, pool.map(comptes, categories)))
+
+def matrice_correlations(comptes):
+    """
+    Toutes les paires d'un coup -> (DataFrame zones x catégories, matrice de Pearson).
+    Chaque paire est mesurée sur les zones où l'une OU l'autre catégorie est présente
+    (celles du nuage de points) : les autres catégories ne changent pas son r.
+    Moins de MIN_ZONES_CORRELATION zones ou catégorie constante -> NaN.
+    """
+    comptes = {cat: serie for cat, serie in comptes.items() if len(serie)}
+    if not comptes: return pd.DataFrame(), pd.DataFrame()
+    tableau = pd.concat(comptes, axis=1).fillna(0)
+    m = tableau.to_numpy(np.float64)
+    presence = (m > 0).astype(np.float64)
+    # Hors de ses zones une catégorie vaut 0 : sommes et produits ne dépendent pas de la paire, seul n en dépend
+    nb = presence.sum(axis=0)
+    n = nb[:, None] + nb[None, :] - presence.T @ presence  # |zones de A ∪ zones de B|
+    somme, carres, produits = m.sum(axis=0), (m ** 2).sum(axis=0), m.T @ m
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = produits - np.outer(somme, somme) / n
+        var_a = carres[:, None] - somme[:, None] ** 2 / n
+        var_b = carres[None, :] - somme[None, :] ** 2 / n
+        r = cov / np.sqrt(var_a * var_b)
+    r[n < MIN_ZONES_CORRELATION] = np.nan
+    r = np.clip(r, -1, 1)
+    return tableau, pd.DataFrame(r, index=tableau.columns, columns=tableau.columns)
+
+@st.cache_data(ttl=TTL_CORRELATIONS, show_spinner=False)
+def correlations_ville(ville_nom, categories):
+    """ (tableau des comptes, matrice) d'une ville : un seul calcul par ville et par TTL, pour toutes les sessions """
+    return matrice_correlations(comptes_zones_ville(CONFIG_VILLES[ville_nom], list(categories)))
+
+def paire_la_plus_liee(matrice):
+    """ (cat_a, cat_b) au |r| le plus fort hors diagonale, None si rien de calculable """
+    r = np.abs(matrice.to_numpy(np.float64))
+    r[np.tril_indices_from(r)] = np.nan
+    if np.isnan(r).all(): return None
+    i, j = np.unravel_index(np.nanargmax(r), r.shape)
+    return matrice.index[i], matrice.columns[j]
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def geocoder_adresse(adresse, centre):
+    """
+    Adresse -> (lat, lon, libellé) via la Base Adresse Nationale (None si introuvable).
+    Service en échec : exception, pour que l'échec ne soit pas gardé en cache.
+    """
+    r = requete_http("https://api-adresse.data.gouv.fr/search/",
+                     params={"q": adresse, "limit": 1, "lat": centre[0], "lon": centre[1]})
+    if r.status_code != 200: raise PortailIndisponible(f"Base Adresse Nationale : erreur {r.status_code}")
+    features = r.json().get("features", [])
+    if not features: return None
+    lon, lat = features[0]["geometry"]["coordinates"]
+    return float(lat), float(lon), features[0]["properties"].get("label", adresse)
+
+def filtrer_par_texte(entree, config_ville, config_data, filtre_texte):
+    """ Filtre 'Recherche zone' : positions des lignes trouvées, les plus pertinentes d'abord """
+    return chercher_index(index_texte_jeu(entree, config_ville, config_data), filtre_texte)
+
+# --- MÉTÉO & QUALITÉ DE L'AIR (toutes les villes en une requête Open-Meteo) ---
+TTL_METEO = 600  # Météo actuelle
+TTL_QUALITE_AIR = 3600  # Courbes horaires de qualité de l'air
+BUDGET_METEO = 5  # secondes max par requête groupée
+PAUSE_ECHEC_METEO = 60  # après un échec, les reruns servent la dernière réponse sans réessayer
+
+def centres_villes():
+    """ ((ville, lat, lon), ...) pour toutes les villes du catalogue """
+    # En-têtes seulement : inutile de charger les catégories de chaque ville
+    return tuple((nom, entete["coords_center"][0], entete["coords_center"][1]) for nom, entete in CONFIG_VILLES.entetes.items())
+
+def requete_multi_lieux(url, centres, params):
+    """ Open-Meteo accepte des listes de coordonnées : une réponse par lieu, dans le même ordre """
+    params = dict(params, latitude=",".join(str(lat) for _, lat, _ in centres),
+                  longitude=",".join(str(lon) for _, _, lon in centres))
+    r = requete_http(url, params=params, echeance=time.monotonic() + BUDGET_METEO)
+    if r.status_code != 200: raise PortailIndisponible(f"Open-Meteo : erreur {r.status_code}")
+    reponses = r.json()
+    if isinstance(reponses, dict): reponses = [reponses]  # Un seul lieu : objet simple
+    return {nom: reponse for (nom, _, _), reponse in zip(centres, reponses)}
+
+@st.cache_data(ttl=TTL_METEO, show_spinner=False)
+def meteo_villes(centres):
+    """ Météo actuelle de chaque ville """
+    reponses = requete_multi_lieux("https://api.open-meteo.com/v1/forecast", centres, {"current_weather": "true"})
+    return {nom: r.get("current_weather", {}) for nom, r in reponses.items()}
+
+@st.cache_data(ttl=TTL_QUALITE_AIR, show_spinner=False)
+def qualite_air_villes(centres):
+    """ Courbes horaires de pollution de chaque ville (3 jours passés + 2 de prévision) """
+    reponses = requete_multi_lieux("https://air-quality-api.open-meteo.com/v1/air-quality", centres, {
         "hourly": "pm10,pm2_5,nitrogen_dioxide,ozone,aerosol_optical_depth",
         "timezone": "Europe/Paris",
         "past_days": 3,
         "forecast_days": 2
+    })
+    mapper = {
+        "time": "Heure",
+        "pm10": "Particules PM10",
+        "pm2_5": "Particules PM2.5",
+        "nitrogen_dioxide": "Dioxyde d'Azote (NO2)",
+        "ozone": "Ozone (O3)",
+        "aerosol_optical_depth": "Densité Aérosol"
     }
+    return {nom: pd.DataFrame(r.get("hourly", {})).rename(columns=mapper) for nom, r in reponses.items()}
+
+@st.cache_resource(show_spinner=False)
+def registre_meteo():
+    """ Dernière réponse valable de chaque service + date de son dernier échec (communs au process) """
+    return {"derniers": {}, "echecs": {}, "verrou": threading.Lock()}
+
+def appeler_service_meteo(service):
+    """
+    Réponse de service (toutes les villes), ou en cas d'échec la dernière valable (même périmée, None si aucune).
+    Un échec n'est pas mis en cache : on réessaie seulement après PAUSE_ECHEC_METEO.
+    """
+    etat = registre_meteo()
+    with etat["verrou"]:
+        en_pause = time.time() - etat["echecs"].get(service, 0) < PAUSE_ECHEC_METEO
+        dernier = etat["derniers"].get(service)
+    if en_pause: return dernier
     try:
-        r = requests.get(url, params=params)
-        data = r.json()
-        hourly = data.get("hourly", {})
-        df = pd.DataFrame(hourly)
-        mapper = {
-            "time": "Heure",
-            "pm10": "Particules PM10",
-            "pm2_5": "Particules PM2.5",
-            "nitrogen_dioxide": "Dioxyde d'Azote (NO2)",
-            "ozone": "Ozone (O3)",
-            "aerosol_optical_depth": "Densité Aérosol"
-        }
-        df = df.rename(columns=mapper)
-        return df
-    except Exception as e:
-        return pd.DataFrame()
-
-def get_current_weather(lat, lon):
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "current_weather": "true"
-    }
-    try:
-        r = requests.get(url, params=params)
-        return r.json().get("current_weather", {})
-    except: return None
+        valeur = service(centres_villes())
+    except Exception:
+        with etat["verrou"]:
+            etat["echecs"][service] = time.time()
+        return dernier
+    with etat["verrou"]:
+        etat["derniers"][service] = valeur
+        etat["echecs"].pop(service, None)
+    return valeur
+
+def charger_meteo_pollution(ville_nom):
+    return (appeler_service_meteo(qualite_air_villes) or {}).get(ville_nom, pd.DataFrame())
+
+def get_current_weather(ville_nom):
+    return (appeler_service_meteo(meteo_villes) or {}).get(ville_nom)
+
+def rafraichir_meteo():
+    """ Appelé par le planificateur : les caches expirés sont rechargés hors des reruns """
+    for service in (meteo_villes, qualite_air_villes):
+        appeler_service_meteo(service)
 
 # ==========================================
 # 3. INTERFACE STREAMLIT
@@ -519,12 +1868,16 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+planificateur_prechauffage()
+
 if 'ville_selectionnee' not in st.session_state:
-    st.session_state.ville_selectionnee = list(CONFIG_VILLES.keys())[0]
+    st.session_state.ville_selectionnee = next(CONFIG_VILLES.villes_valides())[0]
 if 'cat_selectionnee' not in st.session_state:
     st.session_state.cat_selectionnee = list(CONFIG_VILLES[st.session_state.ville_selectionnee]["categories"].keys())[0]
 if 'dernier_choix' not in st.session_state:
     st.session_state.dernier_choix = None
+if 'vues_carte' not in st.session_state:
+    st.session_state.vues_carte = {}  # Emprise/zoom des cartes qui suivent la vue, par ville
 
 col_logo, col_titre = st.columns([2, 10])
 with col_logo:
@@ -547,7 +1900,7 @@ with st.sidebar:
     def valider_recherche():
         requete = st.session_state.recherche_input
         if requete:
-            ville, cat = moteur_recherche(requete, CONFIG_VILLES)
+            ville, cat = moteur_recherche(requete, CONFIG_VILLES, ville_courante=st.session_state.get("ville_selectionnee"))
             if ville:
                 st.session_state.ville_selectionnee = ville
                 if cat:
@@ -581,11 +1934,19 @@ with st.sidebar:
     
     # 1. Choix de la Ville
     ville_actuelle = st.selectbox("Choisir une ville :", options=list(CONFIG_VILLES.keys()), key="ville_selectionnee")
-    config_ville = CONFIG_VILLES[ville_actuelle]
+    config_ville = CONFIG_VILLES.ville_ou_rien(ville_actuelle)
+    if config_ville is None:
+        st.error(f"Catalogue de {ville_actuelle} invalide : {CONFIG_VILLES.erreurs.get(ville_actuelle)}")
+        st.stop()
+    # Le point "Autour de moi" appartient à la ville : on l'oublie quand elle change
+    if st.session_state.get("ville_point_reference") != ville_actuelle:
+        for cle in ("point_reference", "adresse_geocodee", "adresse_reference", "dernier_clic"):
+            st.session_state.pop(cle, None)
+        st.session_state.ville_point_reference = ville_actuelle
     all_categories = config_ville["categories"]
     
     # --- WIDGET MÉTÉO ---
-    weather_now = get_current_weather(config_ville["coords_center"][0], config_ville["coords_center"][1])
+    weather_now = get_current_weather(ville_actuelle)
     if weather_now:
         temp = weather_now.get("temperature")
         st.info(f"⛅ Météo actuelle : **{temp}°C**")
@@ -593,34 +1954,15 @@ with st.sidebar:
     st.divider()
     
     # --- LOGIQUE DE LISTES DYNAMIQUES (THEME -> DONNEE) ---
-    THEMES = {
-        "🚍 Transport": ["parking", "vélo", "bus", "bicloo", "parcs relais", "métro"],
-        "🌿 Nature & Air": ["vert", "jardin", "air", "pollution", "parc", "fraîcheur", "occupation"],
-        "🎭 Culture & Sorties": ["sortie", "événement", "agenda", "salle", "piscine"],
-        "⚕️ Santé & Sécurité": ["défibrillateur", "laboratoire", "secours", "urgence"],
-        "🚸 Éducation & Enfance": ["école", "collège", "crèche", "maternelle"],
-        "🛠️ Services & Vie Pratique": ["wifi", "toilette", "sanisette", "fontaine", "chantier"]
-    }
-
-    def trouver_theme(nom_cat):
-        nom_clean = nom_cat.lower()
-        for theme, mots_cles in THEMES.items():
-            if any(mot in nom_clean for mot in mots_cles):
-                return theme
-        return "📂 Autres" 
-
-    cats_par_theme = {}
-    for cat in all_categories.keys():
-        th = trouver_theme(cat)
-        if th not in cats_par_theme: cats_par_theme[th] = []
-        cats_par_theme[th].append(cat)
+    # Thèmes précalculés au chargement de la ville (catalogue)
+    cats_par_theme = config_ville["cats_par_theme"]
     
     # --- FIX: FORCER LE THEME SI UNE RECHERCHE A ÉTÉ FAITE ---
     theme_par_defaut = 0
     cat_actuelle = st.session_state.cat_selectionnee
     
     # On trouve le thème de la catégorie actuelle
-    theme_trouve = trouver_theme(cat_actuelle)
+    theme_trouve = all_categories[cat_actuelle]["theme"] if cat_actuelle in all_categories else trouver_theme(cat_actuelle, CONFIG_VILLES.themes)
     liste_themes = sorted(list(cats_par_theme.keys()))
     
     if theme_trouve in liste_themes:
@@ -642,6 +1984,33 @@ with st.sidebar:
     st.divider()
     st.header("⚙️ Paramètres")
     activer_voix = st.checkbox("Activer l'assistant vocal", value=True)
+
+    # Vue admin : ?admin=<secret> dans l'URL (cache et planificateur sont communs à toutes les sessions)
+    if est_admin():
+        with st.expander("🗄️ Cache disque (admin)"):
+            contenu_cache = lister_cache_disque()
+            if contenu_cache:
+                st.caption(f"{len(contenu_cache)} jeux · {sum(e['taille (Ko)'] for e in contenu_cache) / 1024:.1f} Mo")
+                st.dataframe(pd.DataFrame(contenu_cache), hide_index=True)
+                if st.button("🗑️ Vider le cache disque"):
+                    purger_cache_disque()
+                    vider_registre_donnees()
+                    st.cache_data.clear()
+                    st.rerun()
+            else:
+                st.caption("Cache vide.")
+        with st.expander("🛠️ Préchauffage (admin)", expanded=True):
+            etat_prechauffage = planificateur_prechauffage()
+            if not etat_prechauffage["actif"]:
+                st.caption("Désactivé (CITYPULSE_PRECHAUFFAGE=0).")
+            elif etat_prechauffage["dernier_passage"]:
+                st.caption("Dernier passage : " + time.strftime("%H:%M:%S", time.localtime(etat_prechauffage["dernier_passage"])))
+            if etat_prechauffage["erreur_passage"]:
+                st.error(f"Dernier passage en échec : {etat_prechauffage['erreur_passage']}")
+            statut = statut_prechauffage()
+            if statut:
+                st.caption(f"{sum(1 for t in statut if t['Erreur'])} erreur(s) · {len(statut)} jeux suivis")
+                st.dataframe(pd.DataFrame(statut), hide_index=True)
     
     config_data = all_categories[choix_utilisateur_brut]
     if config_data.get("no_map"):
@@ -651,11 +2020,14 @@ with st.sidebar:
 
     mode_filtre = False
     filtre_texte = ""
+    filtre_portail = False
     if type_visu == "CARTE" and config_data.get("api_id") != "custom_meteo":
         st.header("🔎 Filtres")
         mode_filtre = st.toggle("Filtrer par zone", value=False)
         if mode_filtre:
             filtre_texte = st.text_input("Recherche zone :")
+            filtre_portail = st.toggle("🌐 Chercher sur tout le portail", value=False,
+                                       help="La recherche est faite par le portail Open Data : résultats complets, même au-delà des lignes chargées.")
     
     # -----------------------------
     # SECTION "CITY PULSE SCORE" RETIRÉE ICI
@@ -665,9 +2037,13 @@ with st.sidebar:
 choix_utilisateur = choix_utilisateur_brut
 cle_unique = f"{ville_actuelle}_{choix_utilisateur}"
 
+emplacement_voix = st.sidebar.empty()
 if cle_unique != st.session_state.dernier_choix:
     if activer_voix:
-        jouer_son_automatique(f"Chargement : {ville_actuelle}, {choix_utilisateur}")
+        # Jouée en fin de script (survit à un st.rerun intermédiaire)
+        st.session_state.annonce_vocale = phrase_chargement(ville_actuelle, choix_utilisateur)
+        st.session_state.annonce_vocale_le = time.time()
+        demander_son(st.session_state.annonce_vocale)  # La synthèse démarre pendant le rendu de la page
     st.session_state.dernier_choix = cle_unique
 
 # =========================================================
@@ -677,8 +2053,7 @@ if config_data.get("api_id") == "custom_meteo":
     st.subheader(f"📉 Évolution de la pollution : {ville_actuelle}")
     
     with st.spinner("Récupération des données atmosphériques..."):
-        lat, lon = config_ville["coords_center"]
-        df_meteo = charger_meteo_pollution(lat, lon)
+        df_meteo = charger_meteo_pollution(ville_actuelle)
     
     if not df_meteo.empty:
         cols_dispo = [c for c in df_meteo.columns if c != "Heure"]
@@ -713,27 +2088,27 @@ if config_data.get("api_id") == "custom_meteo":
 # BRANCHEMENT B : LE CODE CLASSIQUE (CARTES / API)
 # =========================================================
 else:
+    # Recherche côté portail : le jeu EST le résultat du filtre (cache séparé par requête)
+    recherche_portail = filtre_texte if (mode_filtre and filtre_portail and tokeniser(filtre_texte)) else None
     with st.spinner(f"Chargement des données de {ville_actuelle}..."):
-        limit_req = 1000 if "frequentation" in config_data["api_id"] else 600
-        raw_data = charger_donnees(config_ville["api_url"], config_data["api_id"], cible=limit_req)
+        jeu = charger_categorie(config_ville, config_data, recherche=recherche_portail)
 
-    tous_resultats = raw_data if isinstance(raw_data, list) else []
+    tous_resultats = jeu["lignes"]
+    table = table_jeu(jeu, config_ville, config_data)
+    if jeu["partiel"] and tous_resultats:
+        st.warning(f"⏱️ Portail lent : affichage partiel ({len(tous_resultats)} lignes). La suite sera chargée en arrière-plan.")
 
     # --- FILTRAGE TEXTUEL ---
+    # Vues sur le jeu partagé (aucune copie des enregistrements)
     resultats_finaux = []
+    positions_filtre = None  # None = pas de filtre
     if len(tous_resultats) > 0:
-        if mode_filtre and filtre_texte:
-            input_clean = filtre_texte.lower().strip()
-            mots_a_chercher = [input_clean]
-            for site in tous_resultats:
-                trouve = False
-                valeurs_texte = str(site.values()).lower()
-                for variante in mots_a_chercher:
-                    if variante in valeurs_texte:
-                        trouve = True
-                        break
-                if trouve:
-                    resultats_finaux.append(site)
+        if recherche_portail:
+            resultats_finaux = tous_resultats
+            st.success(f"🌐 Filtre portail : {len(resultats_finaux)} lieux.")
+        elif mode_filtre and filtre_texte:
+            positions_filtre = filtrer_par_texte(jeu, config_ville, config_data, filtre_texte)
+            resultats_finaux = [tous_resultats[i] for i in positions_filtre]
             if not resultats_finaux:
                 st.warning(f"⚠️ Aucun résultat pour '{filtre_texte}'")
             else:
@@ -742,6 +2117,8 @@ else:
             resultats_finaux = tous_resultats
             if type_visu == "CARTE":
                 st.success(f"🌍 {ville_actuelle} : {len(resultats_finaux)} lieux trouvés.")
+    elif recherche_portail:
+        st.warning(f"⚠️ Aucun résultat sur le portail pour '{filtre_texte}'")
     else:
         st.info("Pas de données disponibles pour cette catégorie.")
 
@@ -761,84 +2138,146 @@ else:
             with c1:
                 style_vue = st.radio("Vue :", ["📍 Points", "🔥 Densité"], horizontal=True)
             with c2:
-                fond_carte = st.selectbox("Fond de plan :", ["Clair (Défaut)", "Sombre (Nuit)", "Satellite"])
-            
-            # Configuration du fond
-            tiles_layer = "OpenStreetMap" # Défaut
-            attr = None
-            if fond_carte == "Sombre (Nuit)":
-                tiles_layer = "CartoDB dark_matter"
-                attr = "CartoDB"
-            elif fond_carte == "Satellite":
-                tiles_layer = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
-                attr = "Esri"
-
-            m = folium.Map(
-                location=config_ville["coords_center"], 
-                zoom_start=config_ville["zoom_start"],
-                tiles=tiles_layer,
-                attr=attr
-            )
-            
+                fond_carte = st.selectbox("Fond de plan :", list(FONDS_CARTE.keys()))
+
+            # --- AUTOUR DE MOI (index spatial) ---
+            with st.expander("📍 Autour de moi : les lieux les plus proches", expanded=bool(st.session_state.get("point_reference"))):
+                c_adr, c_nb = st.columns([4, 1])
+                with c_adr:
+                    adresse_ref = st.text_input("Adresse (ou cliquez sur la carte) :", key="adresse_reference")
+                with c_nb:
+                    nb_voisins = st.number_input("Nombre :", min_value=1, max_value=20, value=5)
+                dispo_seulement = False
+                if config_data.get("col_disponibilite"):
+                    dispo_seulement = st.checkbox("Seulement les lieux disponibles (> 0)", value=True)
+
+                if adresse_ref and adresse_ref != st.session_state.get("adresse_geocodee"):
+                    try:
+                        point = geocoder_adresse(adresse_ref, tuple(config_ville["coords_center"]))
+                    except Exception:
+                        st.warning("Recherche d'adresse indisponible pour le moment, réessayez.")
+                    else:
+                        st.session_state.adresse_geocodee = adresse_ref
+                        if point: st.session_state.point_reference = point
+                        else: st.warning("Adresse introuvable.")
+
+                point_ref = st.session_state.get("point_reference")
+                proches = None
+                if point_ref:
+                    proches = plus_proches(jeu, config_ville, config_data, point_ref[0], point_ref[1],
+                                           k=int(nb_voisins), positions=positions_filtre, disponible=dispo_seulement)
+                    st.caption(f"Depuis : {point_ref[2]}")
+                    if len(proches) > 0:
+                        st.dataframe(proches[["titre", "adresse", "distance_m"]].rename(
+                            columns={"titre": "Nom", "adresse": "Adresse", "distance_m": "Distance (m)"}), hide_index=True)
+                    else:
+                        st.info("Aucun lieu trouvé à proximité.")
+
+            # Table normalisée (construite une fois par version du jeu)
+            indices = np.arange(len(table)) if positions_filtre is None else np.asarray(positions_filtre, dtype=int)
+            indices = indices[table["lat"].notna().to_numpy()[indices]]
+
+            # --- CHARGEMENT PROGRESSIF (sur demande) : seule la zone visible part vers le navigateur ---
+            progressif = style_vue == "📍 Points" and st.toggle(
+                "🔭 Chargement progressif (zone visible uniquement)", value=False)
+            # Vue qui suit la carte : couche recalculée selon l'emprise et le zoom courants
+            suit_la_vue = progressif or style_vue == "🔥 Densité"
+            cle_carte = f"carte_{ville_actuelle}_{'progressive' if progressif else 'densite' if suit_la_vue else 'complete'}"
+            emprise_connue = False
+            if suit_la_vue:
+                # Emprise et zoom renvoyés par st_folium au rerun précédent
+                etat_carte = st.session_state.get(cle_carte) or st.session_state.vues_carte.get(cle_carte) or {}
+                emprise, zoom = etat_carte.get("bounds") or {}, etat_carte.get("zoom") or config_ville["zoom_start"]
+                emprise_connue = emprise_renseignee(emprise)
+                if emprise_connue:
+                    so, ne = emprise["_southWest"], emprise["_northEast"]
+
             # --- CLUSTERING ---
-            marker_cluster = MarkerCluster().add_to(m) if style_vue == "📍 Points" else None
-            coords_heatmap = []
-            
-            for site in resultats_finaux:
-                lat, lon = recuperer_coordonnees(site)
-
-                if lat and lon:
-                    coords_heatmap.append([lat, lon])
-                    if style_vue == "📍 Points":
-                        titre = site.get(config_data["col_titre"]) or "Lieu"
-                        titre = str(titre).replace('"', '') 
-                        adresse = site.get(config_data["col_adresse"]) or ""
-                        
-                        html_image = ""
-                        if "image_col" in config_data:
-                            url_img = site.get(config_data["image_col"])
-                            if isinstance(url_img, dict): url_img = url_img.get("url")
-                            if url_img: html_image = f'<img src="{url_img}" width="200px" style="border-radius:5px; margin-bottom:10px;"><br>'
-
-                        # LIEN GOOGLE MAPS
-                        gmaps_link = f"https://www.google.com/maps/dir/?api=1&destination={lat},{lon}"
-                        
-                        popup_content = f"""
-                        {html_image}
-                        <b>{titre}</b><br>
-                        <i>{adresse}</i><br>
-                        <a href="{gmaps_link}" target="_blank" style="text-decoration:none;">
-                            <button style="margin-top:5px;cursor:pointer;">📍 Y aller</button>
-                        </a>
-                        """
-                        
-                        infos_html = ""
-                        for k, v in config_data["infos_sup"]:
-                            val = site.get(k)
-                            if val: 
-                                if len(str(val)) > 100: val = str(val)[:100] + "..."
-                                infos_html += f"<br><b>{v}:</b> {val}"
-                        popup_content += infos_html
-
-                        folium.Marker(
-                            [lat, lon], popup=folium.Popup(popup_content, max_width=250),
-                            icon=folium.Icon(color=config_data["couleur"], icon=config_data["icone"], prefix="fa")
-                        ).add_to(marker_cluster if marker_cluster else m)
-
-            if style_vue == "🔥 Densité" and coords_heatmap:
-                HeatMap(coords_heatmap, radius=15).add_to(m)
-            
-            if coords_heatmap or style_vue == "📍 Points":
-                # --- BOUTON DE TELECHARGEMENT HTML ---
-                carte_html = m.get_root().render()
+            couche = None
+            if progressif:
+                visibles = indices
+                if emprise_connue:
+                    dans_vue = dans_emprise(index_spatial_jeu(jeu, config_ville, config_data), so["lat"], so["lng"], ne["lat"], ne["lng"])
+                    visibles = np.intersect1d(indices, dans_vue, assume_unique=True)
+
+                couche = folium.FeatureGroup(name="Zone visible")
+                if len(visibles) > MAX_MARQUEURS_VISIBLES:
+                    # Vue large : un compteur par case plutôt que des centaines de marqueurs
+                    lat_a, lon_a, effectifs = agreger_par_grille(table["lat"].to_numpy(np.float64)[visibles],
+                                                                 table["lon"].to_numpy(np.float64)[visibles], zoom)
+                    for lat, lon, n in zip(lat_a.tolist(), lon_a.tolist(), effectifs.tolist()):
+                        taille = 28 if n < 10 else 36 if n < 100 else 44
+                        folium.Marker([lat, lon], tooltip=f"{n} lieux", icon=folium.DivIcon(
+                            icon_size=(taille, taille), icon_anchor=(taille // 2, taille // 2),
+                            html=f'<div style="width:{taille}px;height:{taille}px;line-height:{taille}px;border-radius:50%;'
+                                 f'background:rgba(51,136,255,0.75);color:white;font-weight:bold;text-align:center;">{n}</div>'
+                        )).add_to(couche)
+                    st.caption(f"🔭 {len(visibles)} lieux dans la zone visible : zoomez pour afficher le détail.")
+                else:
+                    # Peu de lieux : marqueurs individuels, sans regroupement
+                    FastMarkerCluster(donnees_marqueurs(table, visibles), callback=callback_marqueurs(config_data),
+                                      disableClusteringAtZoom=1).add_to(couche)
+                    st.caption(f"🔭 {len(visibles)} lieux dans la zone visible.")
+            elif style_vue == "🔥 Densité" and len(indices):
+                # --- DENSITÉ PRÉ-AGRÉGÉE : seules les cases (visibles) partent vers le navigateur ---
+                lat_d, lon_d, poids = densite_jeu(jeu, config_ville, config_data, zoom, None if positions_filtre is None else indices)
+                if emprise_connue:
+                    marge_lat, marge_lon = (ne["lat"] - so["lat"]) / 4, (ne["lng"] - so["lng"]) / 4
+                    dans_vue = ((lat_d >= so["lat"] - marge_lat) & (lat_d <= ne["lat"] + marge_lat)
+                                & (lon_d >= so["lng"] - marge_lon) & (lon_d <= ne["lng"] + marge_lon))
+                    lat_d, lon_d, poids = lat_d[dans_vue], lon_d[dans_vue], poids[dans_vue]
+                couche = folium.FeatureGroup(name="Densité")
+                couche_densite(lat_d, lon_d, poids, zoom).add_to(couche)
+
+            # Calque de base (marqueurs ou densité) : préparé seulement si ses entrées changent
+            filtre_carte = filtre_texte if positions_filtre is not None else None
+            carte = carte_en_cache(
+                (ville_actuelle, choix_utilisateur, style_vue, fond_carte, filtre_carte, recherche_portail, progressif, jeu["charge_le"]),
+                config_ville, fond_carte,
+                lambda: None if suit_la_vue else calque_carte(config_ville, config_data, table, indices, style_vue))
+
+            # Point de référence + lieux les plus proches mis en évidence
+            couches = [couche] if couche is not None else []
+            if point_ref:
+                repere = folium.FeatureGroup(name="Autour de moi")
+                folium.Marker(point_ref[:2], tooltip=point_ref[2],
+                              icon=folium.Icon(color="black", icon="crosshairs", prefix="fa")).add_to(repere)
+                if proches is not None:
+                    for rang, (lat_p, lon_p, titre_p, d) in enumerate(zip(proches["lat"], proches["lon"], proches["titre"], proches["distance_m"]), 1):
+                        folium.CircleMarker([float(lat_p), float(lon_p)], radius=14, color="red", weight=3, fill=False,
+                                            tooltip=f"#{rang} {titre_p} ({d:.0f} m)").add_to(repere)
+                couches.append(repere)
+
+            if len(indices) or style_vue == "📍 Points":
+                # --- BOUTON DE TELECHARGEMENT HTML (rendu au clic seulement) ---
+                # Vue qui suit la carte : l'export reprend tous les lieux filtrés et pas seulement la zone visible
+                export = (lambda: construire_carte(config_ville, fond_carte, calque_carte(config_ville, config_data, table, indices, style_vue))) if suit_la_vue else None
                 st.download_button(
                     label="💾 Télécharger la carte interactive (HTML)",
-                    data=carte_html,
+                    data=lambda: html_carte(carte, export),
                     file_name=f"carte_{ville_actuelle}_{choix_utilisateur}.html",
-                    mime="text/html"
+                    mime="text/html",
+                    key="telechargement_carte"
                 )
-                
-                st_folium(m, width=1000, height=600, returned_objects=[])
+
+                if suit_la_vue:
+                    # La couche visible est envoyée seule : le fond de carte n'est pas redessiné à chaque déplacement
+                    sortie_carte = afficher_carte(carte, couches, cle_carte, ["last_clicked", "bounds", "zoom"])
+                    vue_rendue = {"bounds": (sortie_carte or {}).get("bounds"), "zoom": (sortie_carte or {}).get("zoom")}
+                    # Première vue : st_folium renvoie une emprise vide ({"_southWest": {"lat": None...}}), rien à recalculer
+                    if emprise_renseignee(vue_rendue["bounds"]) and vue_rendue != {"bounds": etat_carte.get("bounds"), "zoom": etat_carte.get("zoom")}:
+                        # La vue a bougé depuis le calcul des marqueurs : on recalcule la zone visible
+                        st.session_state.vues_carte[cle_carte] = vue_rendue
+                        st.rerun()
+                else:
+                    sortie_carte = afficher_carte(carte, couches, cle_carte, ["last_clicked"])
+
+                # Clic sur la carte = nouveau point de référence pour "Autour de moi"
+                clic = (sortie_carte or {}).get("last_clicked")
+                if clic and clic != st.session_state.get("dernier_clic"):
+                    st.session_state.dernier_clic = clic
+                    st.session_state.point_reference = (clic["lat"], clic["lng"], "Point cliqué sur la carte")
+                    st.rerun()
             else:
                 st.warning("⚠️ Aucune coordonnée GPS trouvée.")
 
@@ -924,16 +2363,14 @@ else:
                 col1, col2 = st.columns(2)
                 with col1: st.metric("Total éléments", len(resultats_finaux))
                 
-                liste_cp = []
-                for s in resultats_finaux:
-                    cp = extraire_cp_intelligent(s, config_data["col_adresse"], prefixe_cp=config_ville["cp_prefix"])
-                    if cp == "Inconnu": cp = str(s.get("address_zipcode", "Inconnu"))
-                    if cp != "Inconnu" and config_ville["cp_prefix"] in cp: 
-                        liste_cp.append(cp)
+                # CP normalisés pré-calculés dans la table
+                serie_cp = table["cp"] if positions_filtre is None else table["cp"].iloc[positions_filtre]
+                liste_cp = serie_cp.dropna()
                 
                 if len(liste_cp) > 0:
-                    df = pd.DataFrame(liste_cp, columns=["Zone / CP"])
-                    compte = df["Zone / CP"].value_counts().sort_index()
+                    compte = liste_cp.astype(str).value_counts().sort_index()
+                    libelle = libelle_zone(config_ville)
+                    compte.index.name = "Zone / CP" if libelle == "CP" else libelle
                     st.bar_chart(compte)
                 else:
                     st.info("Données géographiques insuffisantes pour un graphique.")
@@ -942,17 +2379,35 @@ else:
 
     with tab_donnees:
         st.markdown("### 📥 Exporter les données")
-        if len(resultats_finaux) > 0:
-            df_export = pd.DataFrame(resultats_finaux)
-            csv = df_export.to_csv(index=False).encode('utf-8')
+        # Par défaut seules les colonnes utiles sont téléchargées (select=)
+        colonnes_completes = st.toggle("🧾 Toutes les colonnes (jeu brut)", value=False)
+        jeu_export, positions_export = jeu, positions_filtre
+        if colonnes_completes and len(resultats_finaux) > 0:
+            with st.spinner("Chargement du jeu complet..."):
+                jeu_export = charger_categorie(config_ville, config_data, complet=True, recherche=recherche_portail)
+            if positions_filtre is not None:
+                positions_export = filtrer_par_texte(jeu_export, config_ville, config_data, filtre_texte)
+        if len(resultats_finaux) > 0 and len(jeu_export["lignes"]) > 0:
+            # Tables construites une fois par version du jeu ; le filtre n'en prend qu'une vue
+            # (par défaut la table normalisée, sinon le jeu brut toutes colonnes)
+            if colonnes_completes:
+                df_complet = tableau_jeu(jeu_export)
+            else:
+                df_complet = derive(jeu_export, ("export", choix_utilisateur), lambda _: table_pour_export(table, config_data, libelle_zone(config_ville)))
+            if positions_export is not None:
+                df_export = df_complet.iloc[positions_export]
+                csv = df_export.to_csv(index=False).encode('utf-8')
+            else:
+                df_export = df_complet
+                csv = derive(jeu_export, ("csv", colonnes_completes, choix_utilisateur), lambda _: df_complet.to_csv(index=False).encode('utf-8'))
             col_d1, col_d2 = st.columns([1, 4])
             with col_d1:
                 st.download_button(label="📄 Télécharger en CSV", data=csv, file_name=f"export_{ville_actuelle}_{choix_utilisateur}.csv", mime="text/csv")
             with col_d2:
-                st.info(f"Ce fichier contient les {len(resultats_finaux)} entrées affichées.")
+                st.info(f"Ce fichier contient les {len(df_export)} entrées affichées.")
             st.dataframe(df_export)
             with st.expander("🔍 Débogage (Voir format 1er élément)"):
-                 st.write(resultats_finaux[0])
+                 st.write(dict(resultats_finaux[0]))
         else:
             st.warning("Aucune donnée à exporter.")
 
@@ -962,86 +2417,74 @@ else:
 st.divider()
 st.header("🧪 Labo de Corrélations")
 st.markdown("""
-Recherche de liens entre deux données. 
+Recherche de liens entre toutes les données de la ville, zone par zone.
 * **Paris** : Regroupement par Arrondissement (CP).
 * **Nantes/Rennes** : Regroupement par Zone Géographique (Carrés de ~1km²).
 """)
 
 with st.expander("Créer une analyse croisée", expanded=True):
-    col_a, col_b = st.columns(2)
-    
-    liste_cats_dispo = list(CONFIG_VILLES[ville_actuelle]["categories"].keys())
-    # On enlève "Meteo" car pas de CP
-    liste_cats_dispo = [c for c in liste_cats_dispo if "Meteo" not in c and "Courbe" not in c]
-    
-    cat_a = col_a.selectbox("Axe X (Donnée A)", liste_cats_dispo, index=0)
-    idx_b = 1 if len(liste_cats_dispo) > 1 else 0
-    cat_b = col_b.selectbox("Axe Y (Donnée B)", liste_cats_dispo, index=idx_b)
-    
+    config_ville_labo = CONFIG_VILLES[ville_actuelle]
+    liste_cats_dispo = categories_correlables(config_ville_labo)
+
     if st.button("Lancer la corrélation"):
-        if cat_a == cat_b:
-            st.warning("Choisissez deux catégories différentes.")
+        st.session_state.labo_ville = ville_actuelle
+
+    if st.session_state.get("labo_ville") == ville_actuelle and len(liste_cats_dispo) > 1:
+        # Matrice gardée TTL_CORRELATIONS pour toutes les sessions : reruns et clics ne rechargent rien
+        with st.spinner("Calcul des zones et croisements..."):
+            tableau_zones, matrice = correlations_ville(ville_actuelle, tuple(liste_cats_dispo))
+
+        if len(tableau_zones) >= MIN_ZONES_CORRELATION and matrice.shape[1] > 1:
+            st.write(f"### Matrice sur {len(tableau_zones)} zones détectées")
+            df_matrice = matrice.rename_axis("Donnée A").reset_index().melt(
+                id_vars="Donnée A", var_name="Donnée B", value_name="Corrélation")
+            clic = alt.selection_point(fields=["Donnée A", "Donnée B"], name="paire")
+            base = alt.Chart(df_matrice).encode(
+                x=alt.X("Donnée A:N", sort=list(matrice.columns), title=None),
+                y=alt.Y("Donnée B:N", sort=list(matrice.columns), title=None))
+            heatmap = base.mark_rect().encode(
+                color=alt.Color("Corrélation:Q", scale=alt.Scale(scheme="redblue", domain=[-1, 1])),
+                opacity=alt.condition(clic, alt.value(1), alt.value(0.5)),
+                tooltip=["Donnée A", "Donnée B", alt.Tooltip("Corrélation:Q", format=".2f")]
+            ).add_params(clic)
+            texte = base.mark_text(fontSize=10).encode(text=alt.Text("Corrélation:Q", format=".2f"))
+            choix_matrice = st.altair_chart((heatmap + texte).properties(height=60 + 45 * matrice.shape[1]),
+                                            use_container_width=True, on_select="rerun", key="matrice_correlations")
+
+            # Clic sur une case -> nuage de points de la paire (par défaut : le lien le plus fort)
+            selection = (choix_matrice or {}).get("selection", {}).get("paire") or []
+            paire = (selection[0]["Donnée A"], selection[0]["Donnée B"]) if selection else paire_la_plus_liee(matrice)
+            if paire and paire[0] != paire[1]:
+                cat_a, cat_b = paire
+                df_corr = tableau_zones[[cat_a, cat_b]].set_axis(["Data_A", "Data_B"], axis=1)
+                df_corr = df_corr[(df_corr["Data_A"] > 0) | (df_corr["Data_B"] > 0)]
+                df_corr["Zone"] = df_corr.index
+
+                c1, c2 = st.columns([3, 1])
+                with c1:
+                    chart_corr = alt.Chart(df_corr).mark_circle(size=100).encode(
+                        x=alt.X('Data_A', title=f"Nombre : {cat_a}"),
+                        y=alt.Y('Data_B', title=f"Nombre : {cat_b}"),
+                        color=alt.Color('Zone', legend=None),
+                        tooltip=['Zone', 'Data_A', 'Data_B']
+                    ).interactive()
+                    st.altair_chart(chart_corr, use_container_width=True)
+
+                with c2:
+                    corr = matrice.loc[cat_a, cat_b]
+                    st.metric("Corrélation", "—" if pd.isna(corr) else f"{corr:.2f}")
+                    if corr > 0.5: st.success("📈 Lien Positif")
+                    elif corr < -0.5: st.warning("📉 Lien Négatif")
+                    else: st.info("😐 Pas de lien net")
+            else:
+                st.info("Cliquez sur une case de la matrice pour voir le détail d'une paire.")
         else:
-            with st.spinner("Calcul des zones et croisements..."):
-                conf_a = CONFIG_VILLES[ville_actuelle]["categories"][cat_a]
-                conf_b = CONFIG_VILLES[ville_actuelle]["categories"][cat_b]
-                
-                data_a = charger_donnees(CONFIG_VILLES[ville_actuelle]["api_url"], conf_a["api_id"])
-                data_b = charger_donnees(CONFIG_VILLES[ville_actuelle]["api_url"], conf_b["api_id"])
-                
-                # --- FONCTION INTELLIGENTE : SI PAS PARIS, ON UTILISE LA GRILLE GPS ---
-                def get_zone_id(item, conf, ville_nom, prefix):
-                    # 1. Essayer le Code Postal (Prioritaire pour Paris)
-                    if "Paris" in ville_nom:
-                        cp = extraire_cp_intelligent(item, conf.get("col_adresse", ""), prefix)
-                        if prefix in str(cp) and "Inconnu" not in str(cp):
-                            return cp
-                    
-                    # 2. Sinon (Nantes/Rennes), on fait un maillage GPS (Grid System)
-                    lat, lon = recuperer_coordonnees(item)
-                    if lat and lon:
-                        # MODIFICATION ICI : Retour à round(2) pour éviter NaN
-                        grid_lat = round(lat, 2) 
-                        grid_lon = round(lon, 2)
-                        return f"Zone GPS {grid_lat}/{grid_lon}"
-                    
-                    return None
-
-                def compter_par_zone_intelligente(data, conf, ville_nom, prefix):
-                    zones = []
-                    for item in data:
-                        z = get_zone_id(item, conf, ville_nom, prefix)
-                        if z: zones.append(z)
-                    return pd.Series(zones).value_counts()
-
-                # Création des séries
-                prefixe_ville = CONFIG_VILLES[ville_actuelle]["cp_prefix"]
-                serie_a = compter_par_zone_intelligente(data_a, conf_a, ville_actuelle, prefixe_ville)
-                serie_b = compter_par_zone_intelligente(data_b, conf_b, ville_actuelle, prefixe_ville)
-                
-                # Fusion
-                df_corr = pd.concat([serie_a, serie_b], axis=1, keys=['Data_A', 'Data_B']).dropna()
-                df_corr['Zone'] = df_corr.index
-                
-                if not df_corr.empty and len(df_corr) > 2:
-                    st.write(f"### Résultat sur {len(df_corr)} zones détectées")
-                    
-                    c1, c2 = st.columns([3, 1])
-                    with c1:
-                        chart_corr = alt.Chart(df_corr).mark_circle(size=100).encode(
-                            x=alt.X('Data_A', title=f"Nombre : {cat_a}"),
-                            y=alt.Y('Data_B', title=f"Nombre : {cat_b}"),
-                            color=alt.Color('Zone', legend=None),
-                            tooltip=['Zone', 'Data_A', 'Data_B']
-                        ).interactive()
-                        st.altair_chart(chart_corr, use_container_width=True)
-                    
-                    with c2:
-                        corr = df_corr['Data_A'].corr(df_corr['Data_B'])
-                        st.metric("Corrélation", f"{corr:.2f}")
-                        if corr > 0.5: st.success("📈 Lien Positif")
-                        elif corr < -0.5: st.warning("📉 Lien Négatif")
-                        else: st.info("😐 Pas de lien net")
-                else:
-                    st.error("Pas assez de données géographiques communes.")
-                    st.write("Conseil : Vérifiez que les deux catégories ont bien des coordonnées GPS.")
+            st.error("Pas assez de données géographiques communes.")
+            st.write("Conseil : Vérifiez que les catégories ont bien des coordonnées GPS.")
+
+# --- ANNONCE VOCALE (en dernier : la page est déjà affichée) ---
+if st.session_state.get("annonce_vocale"):
+    jouee = jouer_son_automatique(emplacement_voix, st.session_state.annonce_vocale)
+    # Synthèse pas finie : l'annonce attend le prochain rerun, tant qu'elle est encore d'actualité
+    if jouee is not None or time.time() - st.session_state.get("annonce_vocale_le", 0) > ATTENTE_MAX_VOIX:
+        st.session_state.annonce_vocale = None